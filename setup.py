@@ -63,5 +63,10 @@ setup (
         'setuptools',
         'zope.component',
         ],
+    entry_points = dict(
+        console_scripts = [
+            'z3c.json-benchmarks = z3c.json.benchmarks:main',
+            ],
+        ),
     zip_safe = False,
 )
@@ -0,0 +1,263 @@
+##############################################################################
+#
+# Copyright (c) 2007 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Benchmarks
+
+Run them with the ``z3c.json-benchmarks`` script or
+``python -m z3c.json.benchmarks``. The results are written as JSON with
+``--output`` and can be compared against such a file with ``--baseline``.
+
+$Id:$
+"""
+__docformat__ = "reStructuredText"
+
+import BaseHTTPServer
+import gc
+import optparse
+import sys
+import threading
+import timeit
+
+from z3c.json import converter
+from z3c.json import minjson
+from z3c.json import testing
+from z3c.json.proxy import JSONRPCProxy
+
+
+def bench(func, number=10, repeat=3):
+    """Return the best time of func in seconds per call"""
+    timer = timeit.Timer(func)
+    return min(timer.repeat(repeat, number)) / number
+
+
+def corpora():
+    """Return the synthetic payloads by name"""
+    # the json and cjson backends recurse, stay well below the limit
+    deep = []
+    for i in range(50):
+        deep = [i, {u'children': deep}]
+    return {
+        'envelope': {u'jsonrpc': u'2.0', u'id': u'jsonrpc',
+                     u'method': u'getUser', u'params': [u'jessy', 42, True]},
+        'wide': dict((u'key%d' % i, i) for i in range(5000)),
+        'deep': deep,
+        'strings': [u'Lorem ipsum "dolor" sit amet,\tconsectetur %d.\n' % i
+                    * 20 for i in range(500)],
+        'numbers': [i * 1.5 for i in range(5000)] + range(5000),
+        'records': [dict((u'field%d' % j, i * j) for j in range(20))
+                    for i in range(2000)],
+        }
+
+
+def textPayloads():
+    """Return text-heavy payloads by name"""
+    return {
+        'short': [u'name%d' % i for i in range(10000)],
+        'plain': [u'Lorem ipsum dolor sit amet, consectetur %d' % i
+                  for i in range(10000)],
+        'escapes': [u'line\n"quoted"\ttab \\ back %d\r\n' % i * 5
+                    for i in range(10000)],
+        'long': [u'Lorem ipsum "dolor" sit amet.\n' * 1000] * 10,
+        }
+
+
+def benchCodecs():
+    """minjson and the converter utilities on the corpora"""
+    testing.setUpJSONConverter()
+    reader = converter.JSONReader()
+    writer = converter.JSONWriter()
+    for name, data in sorted(corpora().items()):
+        text = minjson.write(data)
+        yield 'minjson.read.%s' % name, lambda: minjson.read(text)
+        yield 'minjson.write.%s' % name, lambda: minjson.write(data)
+        yield 'converter.read.%s' % name, lambda: reader.read(text)
+        yield 'converter.write.%s' % name, lambda: writer.write(data)
+        yield 'premarshal.%s' % name, lambda: converter.premarshal(data)
+        yield ('premarshal+write.%s' % name,
+               lambda: minjson.write(converter.premarshal(data)))
+        yield ('writePremarshalled.%s' % name,
+               lambda: converter.writePremarshalled(data))
+
+
+def benchStrmangle():
+    """The string escaping on text-heavy payloads"""
+    for name, texts in sorted(textPayloads().items()):
+        yield ('strmangle.%s' % name,
+               lambda: [minjson.strmangle(t) for t in texts])
+
+
+def sizeof(obj):
+    """Return the bytes taken by obj and the objects it refers to
+
+    Shared objects are counted once, classes and modules not at all.
+    """
+    seen = set()
+    size = 0
+    stack = [obj]
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen or isinstance(obj, (type, type(sys))):
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        stack.extend(gc.get_referents(obj))
+    return size
+
+
+def memoryReading():
+    """The bytes taken by the objects minjson reads"""
+    text = minjson.write(corpora()['records'])
+    yield 'memory.minjson.read.records', lambda: minjson.read(text)
+    yield ('memory.minjson.read.records.compact',
+           lambda: minjson.read(text, records=True))
+
+
+class EchoHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Answer every JSON-RPC call with its params"""
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['content-length']))
+        request = minjson.read(body)
+        response = minjson.write({u'jsonrpc': u'2.0', u'id': request['id'],
+                                  u'result': request['params']})
+        response = response.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_request(self, *args, **kws):
+        pass
+
+
+def benchProxy():
+    """Full JSONRPCProxy round trips against a local server"""
+    testing.setUpJSONConverter()
+    server = BaseHTTPServer.HTTPServer(('localhost', 0), EchoHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.setDaemon(True)
+    thread.start()
+    try:
+        proxy = JSONRPCProxy('http://localhost:%d/' % server.server_port)
+        data = corpora()
+        for name in ('envelope', 'numbers', 'strings'):
+            params = data[name]
+            yield 'proxy.echo.%s' % name, lambda: proxy.echo(params)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+benchmarks = [
+    benchCodecs,
+    benchStrmangle,
+    benchProxy,
+    ]
+
+# these yield the functions returning the objects to measure
+memoryBenchmarks = [
+    memoryReading,
+    ]
+
+
+def run(number=10, repeat=3, filter=None):
+    """Run the benchmarks and return {name: seconds per call or bytes}"""
+    results = {}
+    for benchmark in benchmarks:
+        # each benchmark yields (name, function to time)
+        for name, func in benchmark():
+            if filter is None or filter in name:
+                results[name] = bench(func, number, repeat)
+    for benchmark in memoryBenchmarks:
+        for name, func in benchmark():
+            if filter is None or filter in name:
+                results[name] = sizeof(func())
+    return results
+
+
+def compare(results, baseline, tolerance=0.1):
+    """Return (name, baseline, current, ratio) for results in the baseline
+
+    and the names that are more than tolerance slower than the baseline.
+    """
+    rows = []
+    regressions = []
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        ratio = float(results[name]) / baseline[name]
+        rows.append((name, baseline[name], results[name], ratio))
+        if ratio > 1 + tolerance:
+            regressions.append(name)
+    return rows, regressions
+
+
+def formatResult(value):
+    # seconds or bytes
+    if isinstance(value, float):
+        return '%.6f' % value
+    return '%d' % value
+
+
+def main(args=None):
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('-n', '--number', type='int', default=10,
+                      help='calls per timing (default %default)')
+    parser.add_option('-r', '--repeat', type='int', default=3,
+                      help='timings per benchmark, the best counts '
+                           '(default %default)')
+    parser.add_option('-f', '--filter',
+                      help='only keep benchmarks containing FILTER')
+    parser.add_option('-o', '--output',
+                      help='write the results as JSON to OUTPUT')
+    parser.add_option('-b', '--baseline',
+                      help='compare with the JSON results in BASELINE')
+    parser.add_option('-t', '--tolerance', type='float', default=0.1,
+                      help='allowed slow down against the baseline '
+                           '(default %default)')
+    options, args = parser.parse_args(args)
+
+    results = run(options.number, options.repeat, options.filter)
+    if options.output:
+        f = open(options.output, 'w')
+        try:
+            f.write(minjson.write(results, outputEncoding='utf-8'))
+        finally:
+            f.close()
+
+    if not options.baseline:
+        print '%-36s %12s' % ('benchmark', 'seconds')
+        for name in sorted(results):
+            print '%-36s %12s' % (name, formatResult(results[name]))
+        return 0
+
+    f = open(options.baseline)
+    try:
+        baseline = minjson.read(f.read())
+    finally:
+        f.close()
+    rows, regressions = compare(results, baseline, options.tolerance)
+    print '%-36s %12s %12s %8s' % ('benchmark', 'baseline', 'current', 'ratio')
+    for name, before, after, ratio in rows:
+        print '%-36s %12s %12s %7.2fx%s' % (
+            name, formatResult(before), formatResult(after), ratio,
+            name in regressions and ' !' or '')
+    if regressions:
+        print '%d benchmarks slower than the baseline' % len(regressions)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -16,8 +16,15 @@ $Id:$
 """
 __docformat__ = "reStructuredText"
 
+import logging
+import os
+import timeit
+import weakref
+
+import zope.component
 import zope.interface
 
+from z3c.json import instrumentation
 from z3c.json import interfaces
 from z3c.json import minjson
 from z3c.json import exceptions
@@ -27,30 +34,353 @@ try:
     import cjson
     hasCJson = True
 except ImportError:
-    import logging
-    logger = logging.getLogger()
-    logger.log(logging.INFO,
-        "Using minjson only. cjson is much faster and available at the cheese "
-        "shop. easy_install python-cjson")
     hasCJson = False
 
+try:
+    import json
+except ImportError:
+    json = None
+
+try:
+    import simplejson
+except ImportError:
+    simplejson = None
+
+logger = logging.getLogger(__name__)
+
+
+class Backend(object):
+    """A JSON codec used by JSONReader and JSONWriter.
+
+    read() and write() may raise one of readErrors or writeErrors for data
+    they can't handle, the caller falls back to minjson then.
+    """
+
+    name = None
+    readErrors = ()
+    writeErrors = ()
+
+    def read(self, aString, encoding=None):
+        raise NotImplementedError
+
+    def write(self, anObject):
+        raise NotImplementedError
+
+    def __repr__(self):
+        return '<%s %r>' % (self.__class__.__name__, self.name)
+
+
+class MinJsonBackend(Backend):
+    """The pure python minjson codec, accepts less-well-constructed JSON."""
+
+    name = 'minjson'
+    readErrors = (minjson.ReadException,)
+    writeErrors = (minjson.WriteException,)
+
+    def read(self, aString, encoding=None):
+        return minjson.read(aString, encoding)
+
+    def write(self, anObject):
+        return minjson.write(anObject)
+
+
+class CJsonBackend(Backend):
+    """The python-cjson codec."""
+
+    name = 'cjson'
+
+    def __init__(self):
+        self.readErrors = (cjson.DecodeError,)
+        self.writeErrors = (cjson.EncodeError,)
+
+    def read(self, aString, encoding=None):
+        # the True parameter here tells cjson to make all strings
+        # unicode. This is a good idea here.
+        return cjson.decode(aString, True)
+
+    def write(self, anObject):
+        return unicode(cjson.encode(anObject))
+
+
+class JsonModuleBackend(Backend):
+    """A codec with the API of the json module, e.g. json or simplejson."""
+
+    # they recurse and give up on deeply nested data, minjson doesn't
+    readErrors = (ValueError, UnicodeDecodeError, RuntimeError)
+    writeErrors = (TypeError, ValueError, UnicodeDecodeError, RuntimeError)
+
+    def __init__(self, module, name=None):
+        self.module = module
+        self.name = name or module.__name__
+
+    def read(self, aString, encoding=None):
+        if not isinstance(aString, unicode):
+            # simplejson returns ASCII strings in a byte string as str, all
+            # strings are unicode like for cjson and minjson
+            aString = unicode(aString, encoding or minjson.emergencyEncoding)
+        return self.module.loads(aString)
+
+    def write(self, anObject):
+        result = self.module.dumps(anObject, separators=(',', ':'),
+                                   ensure_ascii=False)
+        if not isinstance(result, unicode):
+            # only byte strings went in, they are utf-8 like for minjson
+            result = unicode(result, 'utf-8')
+        return result
+
+
+# name -> backend, in order of preference
+backends = {}
+backendOrder = []
+
+def registerBackend(backend, priority=None):
+    """Register a backend, with priority its position in the preference
+
+    A backend registered without priority is the least preferred one after
+    minjson, which is always available.
+    """
+    if backend.name in backends:
+        backendOrder.remove(backend.name)
+    backends[backend.name] = backend
+    if priority is None:
+        backendOrder.append(backend.name)
+    else:
+        backendOrder.insert(priority, backend.name)
+
+def getBackend(name):
+    """Return the backend registered under name"""
+    try:
+        return backends[name]
+    except KeyError:
+        raise ValueError('Unknown JSON backend %r, available are: %s' %
+                         (name, ', '.join(backendOrder)))
+
+if hasCJson:
+    registerBackend(CJsonBackend())
+if simplejson is not None:
+    registerBackend(JsonModuleBackend(simplejson))
+if json is not None:
+    registerBackend(JsonModuleBackend(json))
+registerBackend(MinJsonBackend())
+
+# the backends used by JSONReader and JSONWriter if they don't get one
+readBackend = writeBackend = getBackend(backendOrder[0])
+
+def setBackend(name=None, read=None, write=None):
+    """Select the default backend for reading and writing by name
+
+    name selects both, read and write override it. Without any name the
+    most preferred backend is used.
+    """
+    global readBackend, writeBackend
+    readBackend = getBackend(read or name or backendOrder[0])
+    writeBackend = getBackend(write or name or backendOrder[0])
+    logger.info("Using JSON backends %s for reading and %s for writing",
+                readBackend.name, writeBackend.name)
+
+def samplePayloads():
+    """Return sample data for calibrate"""
+    record = {u'id': 1, u'name': u'La Pe\xf1a', u'active': True,
+              u'score': 1.25, u'tags': [u'a', u'b'], u'parent': None}
+    return [
+        {u'jsonrpc': u'2.0', u'id': u'jsonrpc', u'method': u'hello',
+         u'params': [u'Jessy', 42]},
+        [dict(record, id=i) for i in range(200)],
+        {u'text': u'Lorem ipsum "dolor" sit amet.\n' * 200},
+        ]
+
+def calibrate(payloads=None, number=20):
+    """Benchmark the backends and select the fastest for read and write
+
+    A backend is only considered for the payloads it reads and writes
+    without falling back. Return {name: (read time, write time)} in seconds.
+    """
+    if payloads is None:
+        payloads = samplePayloads()
+    texts = [minjson.write(payload) for payload in payloads]
+    timings = {}
+    for name in backendOrder:
+        backend = backends[name]
+        try:
+            for payload, text in zip(payloads, texts):
+                if backend.read(text) != payload:
+                    raise ValueError('%s reads differently' % name)
+                backend.write(payload)
+        except (ValueError, TypeError) + backend.readErrors + \
+                backend.writeErrors, e:
+            logger.info("Not calibrating JSON backend %s: %s", name, e)
+            continue
+        timer = timeit.Timer(lambda: [backend.read(t) for t in texts])
+        readTime = min(timer.repeat(3, number)) / number
+        timer = timeit.Timer(lambda: [backend.write(p) for p in payloads])
+        writeTime = min(timer.repeat(3, number)) / number
+        timings[name] = (readTime, writeTime)
+    setBackend(read=min(timings, key=lambda name: timings[name][0]),
+               write=min(timings, key=lambda name: timings[name][1]))
+    return timings
+
+# Z3C_JSON_BACKEND selects a backend by name or runs calibrate
+configured = os.environ.get('Z3C_JSON_BACKEND')
+if configured == 'calibrate':
+    calibrate()
+elif configured:
+    setBackend(configured)
+
+
+def looksLenient(aString):
+    """Guess whether aString needs minjson, i.e. has comments or ' strings
+
+    This has to be much cheaper than a parse, so it only uses substring
+    searches. Strings a strict backend rejects anyway are caught by the
+    fall back in JSONReader.read.
+    """
+    if '/*' in aString:
+        return True
+    if '//' in aString and aString.count('//') != aString.count('://'):
+        # not only urls
+        return True
+    # single quoted strings start the document or its first item
+    start = aString[:16].lstrip()
+    if start[:1] in ('{', '['):
+        start = start[1:].lstrip()
+    return start[:1] == "'"
+
+# JSONReader modes
+STRICT = 'strict'    # try the backend first, fall back to minjson
+LENIENT = 'lenient'  # always use minjson
+AUTO = 'auto'        # use minjson right away if the data looksLenient
+
 
 class JSONReader(object):
-    """JSON reader utility."""
+    """JSON reader utility.
+
+    reads, fallbacks and lenientReads count the read calls, the calls that
+    the backend rejected before minjson read them and the calls that went
+    to minjson right away.
+    """
     zope.interface.implements(interfaces.IJSONReader)
 
+    def __init__(self, backend=None, mode=AUTO):
+        # None means the module wide readBackend
+        if backend is not None:
+            backend = getBackend(backend)
+        if mode not in (STRICT, LENIENT, AUTO):
+            raise ValueError('Unknown JSONReader mode %r' % mode)
+        self.backend = backend
+        self.mode = mode
+        self.reads = 0
+        self.fallbacks = 0
+        self.lenientReads = 0
+
     def read(self, aString, encoding=None):
-        if hasCJson:
+        if instrumentation.subscribers:
+            start = instrumentation.clock()
+            result, backend, fallback = self._read(aString, encoding)
+            instrumentation.notify(instrumentation.TimingEvent(
+                instrumentation.DECODE, instrumentation.clock() - start,
+                len(aString), backend, fallback))
+            return result
+        return self._read(aString, encoding)[0]
+
+    def _read(self, aString, encoding):
+        # return the result, the name of the backend and whether it was a
+        # fall back
+        self.reads += 1
+        backend = self.backend or readBackend
+        fallback = False
+        if backend.name == 'minjson' or self.mode == LENIENT:
+            self.lenientReads += 1
+        elif not isinstance(aString, basestring):
+            # a bytearray, memoryview or mmap, minjson reads it without
+            # copying it to a string
+            self.lenientReads += 1
+        elif self.mode == AUTO and looksLenient(aString):
+            self.lenientReads += 1
+        else:
+            if aString.endswith('\x00'):
+                # Konqueror appends a trailing null
+                aString = aString.rstrip('\x00')
             try:
-                # the True parameter here tells cjson to make all strings 
-                # unicode. This is a good idea here.
-                return cjson.decode(aString, True)
-            except cjson.DecodeError:
+                return backend.read(aString, encoding), backend.name, False
+            except backend.readErrors:
                 # fall back to minjson
-                pass
+                self.fallbacks += 1
+                fallback = True
         # This is a fall-back position for less-well-constructed JSON
         try:
-            return minjson.read(aString, encoding)
+            return minjson.read(aString, encoding), 'minjson', fallback
+        except minjson.ReadException, e:
+            raise exceptions.ResponseError(e)
+
+    def load(self, fileobj, encoding=None):
+        """Read the JSON document in fileobj
+
+        minjson memory maps a regular file or parses the file while it is
+        read, the other backends get the content as a string.
+        """
+        backend = self.backend or readBackend
+        if backend.name != 'minjson' and self.mode != LENIENT:
+            return self.read(fileobj.read(), encoding)
+        self.reads += 1
+        self.lenientReads += 1
+        try:
+            return minjson.load(fileobj, encoding)
+        except minjson.ReadException, e:
+            raise exceptions.ResponseError(e)
+
+    def parser(self, encoding=None):
+        """Return an incremental parser with feed() and close() or None
+
+        Only minjson parses incrementally. The other backends are faster on
+        the whole string, None tells the caller to collect it for read().
+        """
+        backend = self.backend or readBackend
+        if backend.name != 'minjson' and self.mode != LENIENT:
+            return None
+        return JSONParser(encoding)
+
+
+class JSONParser(object):
+    """Incremental JSON parser raising ResponseError on read error.
+
+    With instrumentation subscribers the time spent in feed() and close()
+    is reported as one decode on close().
+    """
+
+    def __init__(self, encoding=None):
+        self._parser = minjson.JSONParser(encoding)
+        self._duration = 0.0
+        self._size = 0
+
+    def feed(self, data):
+        if instrumentation.subscribers:
+            start = instrumentation.clock()
+            self._feed(data)
+            self._duration += instrumentation.clock() - start
+            self._size += len(data)
+        else:
+            self._feed(data)
+
+    def _feed(self, data):
+        try:
+            self._parser.feed(data)
+        except minjson.ReadException, e:
+            raise exceptions.ResponseError(e)
+
+    def close(self):
+        if instrumentation.subscribers:
+            start = instrumentation.clock()
+            result = self._close()
+            instrumentation.notify(instrumentation.TimingEvent(
+                instrumentation.DECODE,
+                self._duration + instrumentation.clock() - start,
+                self._size, 'minjson'))
+            return result
+        return self._close()
+
+    def _close(self):
+        try:
+            return self._parser.close()
         except minjson.ReadException, e:
             raise exceptions.ResponseError(e)
 
@@ -59,30 +389,292 @@ class JSONWriter(object):
     """JSON writer utility."""
     zope.interface.implements(interfaces.IJSONWriter)
 
+    def __init__(self, backend=None):
+        # None means the module wide writeBackend
+        if backend is not None:
+            backend = getBackend(backend)
+        self.backend = backend
+
     def write(self, anObject):
-        if hasCJson:
+        if instrumentation.subscribers:
+            return self._timed(self._write, anObject)
+        return self._write(anObject)[0]
+
+    def writePremarshalled(self, anObject):
+        if instrumentation.subscribers:
+            return self._timed(self._writePremarshalled, anObject)
+        return self._writePremarshalled(anObject)[0]
+
+    def dump(self, anObject, fileobj):
+        """Write the JSON of anObject to fileobj in UTF-8
+
+        minjson writes it while it is encoded, the other backends write the
+        whole string.
+        """
+        backend = self.backend or writeBackend
+        if backend.name != 'minjson':
             try:
-                return unicode(cjson.encode(anObject))
-            except cjson.EncodeError:
+                text = backend.write(anObject)
+            except backend.writeErrors:
                 # fall back to minjson
                 pass
+            else:
+                fileobj.write(text.encode('utf-8'))
+                return
+        try:
+            minjson.dump(anObject, fileobj)
+        except minjson.WriteException, e:
+            raise TypeError, e
+
+    def _timed(self, write, anObject):
+        start = instrumentation.clock()
+        result, backend, fallback = write(anObject)
+        instrumentation.notify(instrumentation.TimingEvent(
+            instrumentation.ENCODE, instrumentation.clock() - start,
+            len(result), backend, fallback))
+        return result
+
+    def _write(self, anObject):
+        # return the result, the name of the backend and whether it was a
+        # fall back
+        backend = self.backend or writeBackend
+        fallback = False
+        if backend.name != 'minjson':
+            try:
+                return backend.write(anObject), backend.name, False
+            except backend.writeErrors:
+                # fall back to minjson
+                fallback = True
+        try:
+            return minjson.write(anObject), 'minjson', fallback
+        except minjson.WriteException, e:
+            raise TypeError, e
+
+    def _writePremarshalled(self, anObject):
+        backend = self.backend or writeBackend
+        if backend.name != 'minjson':
+            # a C encoder on the premarshalled copy beats a single python
+            # traversal
+            return self._write(premarshal(anObject))
         try:
-            return minjson.write(anObject)
+            return writePremarshalled(anObject), 'minjson', False
         except minjson.WriteException, e:
             raise TypeError, e
 
 
+# types premarshalled as they are, without an adapter lookup
+primitiveTypes = frozenset([int, long, float, bool, str, unicode, type(None)])
+
+# premarshaller factories by type for each adapter registry
+_factories = weakref.WeakKeyDictionary()
+_missing = object()
+
+
+class _DeclarationWatcher(object):
+    """Drops the cached factories when what a cached type implements changes
+
+    classImplements doesn't change the adapter registry, it notifies the
+    dependents of the declaration of the class and of its subclasses.
+    """
+
+    def changed(self, originally_changed):
+        _factories.clear()
+
+_watcher = _DeclarationWatcher()
+
+
+def getPremarshallers():
+    """Return (adapter registry, premarshaller factories by type)
+
+    The factories are cached per type until the registry or what a cached
+    type implements changes.
+    """
+    adapters = zope.component.getSiteManager().adapters
+    generation = getattr(adapters, '_generation', None)
+    if generation is None:
+        # can't tell when it changes, cache for this call only
+        return adapters, {}
+    cached = _factories.get(adapters)
+    if cached is None or cached[0] != generation:
+        cached = (generation, {})
+        _factories[adapters] = cached
+    return adapters, cached[1]
+
+
+def _returnSelf(data):
+    # factory for objects which are premarshallers themselves
+    return data
+
+
+def lookupPremarshaller(data, adapters, factories):
+    """Return the premarshaller factory for data or None"""
+    cls = type(data)
+    factory = factories.get(cls, _missing)
+    if factory is not _missing:
+        return factory
+    spec = zope.interface.providedBy(data)
+    if spec.isOrExtends(interfaces.IJSONRPCPremarshaller):
+        factory = _returnSelf
+    else:
+        factory = adapters.lookup((spec,), interfaces.IJSONRPCPremarshaller)
+    # instances without a __dict__ can't provide interfaces directly, they
+    # provide what their type implements unless they are proxies
+    if not cls.__dictoffset__ and spec is zope.interface.implementedBy(cls):
+        if _watcher not in spec.dependents:
+            spec.subscribe(_watcher)
+        factories[cls] = factory
+    return factory
+
+
+def callPremarshaller(factory, data):
+    """Return data premarshalled by the premarshaller factory makes
+
+    A conditional adapter factory may return None, data is returned as it
+    is then.
+    """
+    premarshaller = factory(data)
+    if premarshaller is None:
+        return data
+    return premarshaller()
+
+
 def premarshal(data):
     """Premarshal data before handing it to JSON writer for marshalling
 
     The initial purpose of this function is to remove security proxies
     without resorting to removeSecurityProxy. This way, we can avoid
     inadvertently providing access to data that should be protected.
+
+    Primitive values are returned as they are. Lists, tuples and dicts
+    premarshalled by the default premarshallers are walked without
+    recursion, other objects are given to their premarshaller.
     """
-    premarshaller = interfaces.IJSONRPCPremarshaller(data, alternate=None)
-    if premarshaller is not None:
-        return premarshaller()
-    return data
+    if type(data) in primitiveTypes:
+        return data
+    adapters, factories = getPremarshallers()
+    factory = lookupPremarshaller(data, adapters, factories)
+    if factory is None:
+        return data
+    if factory is ListPreMarshaller:
+        result = []
+        stack = [(iter(data), result, False)]
+    elif factory is DictPreMarshaller:
+        result = {}
+        stack = [(iter(data.items()), result, True)]
+    else:
+        return callPremarshaller(factory, data)
+
+    primitives = primitiveTypes
+    while stack:
+        items, container, isdict = stack[-1]
+        for item in items:
+            if isdict:
+                key, value = item
+                if type(key) not in primitives:
+                    key = premarshal(key)
+            else:
+                value = item
+            if type(value) not in primitives:
+                factory = lookupPremarshaller(value, adapters, factories)
+                if factory is ListPreMarshaller:
+                    child = []
+                    stack.append((iter(value), child, False))
+                    value = child
+                elif factory is DictPreMarshaller:
+                    child = {}
+                    stack.append((iter(value.items()), child, True))
+                    value = child
+                elif factory is not None:
+                    value = callPremarshaller(factory, value)
+            if isdict:
+                container[key] = value
+            else:
+                container.append(value)
+            if stack[-1][1] is not container:
+                # walk the new child container first
+                break
+        else:
+            stack.pop()
+    return result
+
+
+class PremarshallingJsonWriter(minjson.JsonWriter):
+    """minjson writer premarshalling the object while it writes it
+
+    Writes the same text as writing the result of ``premarshal`` but
+    looks up the premarshallers during one traversal, without building an
+    unproxied copy first.
+    """
+
+    def iterwrite(self, obj):
+        adapters, factories = getPremarshallers()
+        primitives = primitiveTypes
+        encodeScalar = self.encodeScalar
+        # the results of other premarshallers are written as they are
+        writeAsIs = super(PremarshallingJsonWriter, self).iterwrite
+        end = _missing
+        stack = []
+        while 1:
+            first = False
+            if type(obj) in primitives:
+                yield encodeScalar(obj)
+            else:
+                factory = lookupPremarshaller(obj, adapters, factories)
+                if factory is ListPreMarshaller:
+                    yield '['
+                    stack.append((iter(obj), ']', False))
+                    first = True
+                elif factory is DictPreMarshaller:
+                    yield '{'
+                    if type(obj) is dict:
+                        # not a proxy, no need to copy the items
+                        stack.append((obj.iteritems(), '}', True))
+                    else:
+                        stack.append((iter(obj.items()), '}', True))
+                    first = True
+                else:
+                    if factory is not None:
+                        obj = callPremarshaller(factory, obj)
+                    for fragment in writeAsIs(obj):
+                        yield fragment
+            # find the next value to write, primitive values are written
+            # right away
+            while stack:
+                items, closer, isdict = stack[-1]
+                item = next(items, end)
+                if item is end:
+                    stack.pop()
+                    yield closer
+                    first = False
+                    continue
+                if isdict:
+                    key, obj = item
+                    if type(key) not in primitives:
+                        key = premarshal(key)
+                    if first:
+                        prefix = encodeScalar(key) + ':'
+                    else:
+                        prefix = ',' + encodeScalar(key) + ':'
+                else:
+                    obj = item
+                    prefix = not first and ',' or ''
+                if type(obj) in primitives:
+                    yield prefix + encodeScalar(obj)
+                    first = False
+                    continue
+                if prefix:
+                    yield prefix
+                break
+            else:
+                return
+
+
+def writePremarshalled(data, encoding='utf-8', outputEncoding=None):
+    """Return the JSON text of premarshal(data) in a single traversal"""
+    writer = PremarshallingJsonWriter(input_encoding=encoding,
+                                      output_encoding=outputEncoding)
+    writer.write(data)
+    return writer.getvalue()
 
 
 class PreMarshallerBase(object):
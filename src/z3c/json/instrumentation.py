@@ -0,0 +1,148 @@
+##############################################################################
+#
+# Copyright (c) 2007 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Instrumentation
+
+Every callable in ``subscribers`` is called with a ``TimingEvent`` when
+JSON is encoded by ``JSONWriter``, decoded by ``JSONReader`` or its
+incremental parser, or sent by ``Transport.request``, failed requests
+included. Nothing is timed while there are no subscribers. Append
+``zope.event.notify`` to get them as zope events, or subscribe an
+``Aggregator`` to collect statistics.
+
+$Id:$
+"""
+__docformat__ = "reStructuredText"
+
+import bisect
+import threading
+import time
+
+import zope.interface
+
+from z3c.json import interfaces
+
+# phases
+ENCODE = 'encode'
+DECODE = 'decode'
+REQUEST = 'request'
+
+# callables getting every TimingEvent
+subscribers = []
+
+clock = time.time
+
+
+class TimingEvent(object):
+    """A timed phase of a JSON-RPC call."""
+    zope.interface.implements(interfaces.ITimingEvent)
+
+    def __init__(self, phase, duration, size, backend=None, fallback=False,
+                 responseSize=None, url=None, error=False):
+        self.phase = phase
+        self.duration = duration
+        self.size = size
+        self.backend = backend
+        self.fallback = fallback
+        self.responseSize = responseSize
+        self.url = url
+        self.error = error
+
+    def __repr__(self):
+        return '<%s %s %.6fs %s bytes>' % (self.__class__.__name__,
+                                          self.phase, self.duration, self.size)
+
+
+def notify(event):
+    """Call the subscribers with event"""
+    for subscriber in subscribers:
+        subscriber(event)
+
+
+class Aggregator(object):
+    """Counters and latency histograms per phase
+
+    Subscribe it, export snapshot() to a metrics system.
+    """
+
+    # upper bounds of the latency buckets in seconds
+    buckets = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+               0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, buckets=None):
+        if buckets is not None:
+            self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self._lock.acquire()
+        try:
+            self._phases = {}
+        finally:
+            self._lock.release()
+
+    def subscribe(self):
+        if self not in subscribers:
+            subscribers.append(self)
+
+    def unsubscribe(self):
+        if self in subscribers:
+            subscribers.remove(self)
+
+    def __call__(self, event):
+        self._lock.acquire()
+        try:
+            stats = self._phases.get(event.phase)
+            if stats is None:
+                stats = self._phases[event.phase] = {
+                    'count': 0, 'fallbacks': 0, 'errors': 0, 'seconds': 0.0,
+                    'bytes': 0,
+                    'backends': {},
+                    # the last bucket counts the durations beyond the bounds
+                    'histogram': [0] * (len(self.buckets) + 1),
+                    }
+            stats['count'] += 1
+            stats['seconds'] += event.duration
+            stats['bytes'] += event.size or 0
+            if event.fallback:
+                stats['fallbacks'] += 1
+            if event.error:
+                stats['errors'] += 1
+            if event.backend is not None:
+                backends = stats['backends']
+                backends[event.backend] = backends.get(event.backend, 0) + 1
+            stats['histogram'][
+                bisect.bisect_left(self.buckets, event.duration)] += 1
+        finally:
+            self._lock.release()
+
+    def snapshot(self):
+        """Return {phase: statistics} as plain data
+
+        The statistics are count, fallbacks, errors, seconds and bytes in
+        total, backends with the count per backend and histogram, a list of
+        (upper bound, count) with None as the bound of the last bucket.
+        """
+        bounds = self.buckets + (None,)
+        self._lock.acquire()
+        try:
+            result = {}
+            for phase, stats in self._phases.items():
+                stats = dict(stats)
+                stats['backends'] = dict(stats['backends'])
+                stats['histogram'] = zip(bounds, stats['histogram'])
+                result[phase] = stats
+            return result
+        finally:
+            self._lock.release()
@@ -24,7 +24,10 @@ class IJSONReader(zope.interface.Interface):
 
     def read(aString):
         """read and interpret a string in JSON as python"""
-        
+
+    def load(fileobj):
+        """read and interpret the JSON in a file object as python"""
+
 
 class IJSONWriter(zope.interface.Interface):
     """JSON writer."""
@@ -33,6 +36,19 @@ class IJSONWriter(zope.interface.Interface):
         """return a JSON unicode string representation of a python object
            Encode if encoding is provided.
         """
+
+    def writePremarshalled(anObject):
+        """return the JSON unicode string of the premarshalled object
+
+        The security proxies are removed by the IJSONRPCPremarshaller
+        adapters while the object is written.
+        """
+
+    def dump(anObject, fileobj):
+        """write the JSON representation of a python object to a file object
+
+        The JSON is written in UTF-8.
+        """
     
 
 class IJSONRPCPremarshaller(zope.interface.Interface):
@@ -40,3 +56,28 @@ class IJSONRPCPremarshaller(zope.interface.Interface):
 
     def __call__():
         """return the object without proxies"""
+
+
+class ITimingEvent(zope.interface.Interface):
+    """A timed phase of a JSON-RPC call"""
+
+    phase = zope.interface.Attribute("""encode, decode or request""")
+
+    duration = zope.interface.Attribute("""Duration in seconds""")
+
+    size = zope.interface.Attribute(
+        """Length of the JSON text written or read, of the request body""")
+
+    backend = zope.interface.Attribute(
+        """Name of the JSON backend which did the work, None for requests""")
+
+    fallback = zope.interface.Attribute(
+        """True if the backend failed and minjson did the work""")
+
+    responseSize = zope.interface.Attribute(
+        """Content-Length of the response to a request if known""")
+
+    url = zope.interface.Attribute(
+        """Host and handler of a request, without user and password""")
+
+    error = zope.interface.Attribute("""True if the request failed""")
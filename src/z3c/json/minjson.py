@@ -48,9 +48,11 @@
 #            outgoing unicode chars above 128
 
 
-from re import compile, sub, search, DOTALL
-from token import ENDMARKER, NAME, NUMBER, STRING, OP, ERRORTOKEN
-from tokenize import tokenize, TokenError, NL
+import codecs
+import mmap
+import os
+import stat
+from re import compile, DOTALL
 
 #Usually, utf-8 will work, set this to utf-16 if you dare.
 emergencyEncoding = 'utf-8'
@@ -65,251 +67,781 @@ class WriteException(Exception):
 #      read JSON object         #
 #################################
 
-slashstarcomment = compile(r'/\*.*?\*/',DOTALL)
-doubleslashcomment = compile(r'//.*\n')
+# whitespace and c-style comments between tokens
+skipRE = compile(r'(?:[ \t\n\r]+|/\*.*?\*/|//[^\n]*\n)*', DOTALL)
+# strings may be quoted with " or ' (javascript style)
+dqstringRE = compile(r'"([^"\\]*(?:\\.[^"\\]*)*)"', DOTALL)
+sqstringRE = compile(r"'([^'\\]*(?:\\.[^'\\]*)*)'", DOTALL)
+keyRE = compile(r'"([^"\\]*(?:\\.[^"\\]*)*)"[ \t\n\r]*:', DOTALL)
+numberRE = compile(r'(-?\d+)(\.\d*)?([eE][-+]?\d+)?')
+escapeRE = compile(r'\\u([dD][89abAB][0-9a-fA-F]{2})\\u([dD][c-fC-F][0-9a-fA-F]{2})'
+                   r'|\\u([0-9a-fA-F]{4})|\\(.)', DOTALL)
 
-unichrRE = compile(r"\\u[0-9a-fA-F]{4,4}")
+skipChars = ' \t\n\r/'
+numberChars = '-0123456789'
+partialExponents = ('e', 'E', 'e-', 'E-', 'e+', 'E+')
+literals = {'t': (u'true', True), 'f': (u'false', False), 'n': (u'null', None)}
 
-def unichrReplace(match):
-    return unichr(int(match.group()[2:],16))
+escapeChars = {'n': u'\n', 'b': u'\b', 'f': u'\f', 't': u'\t', 'r': u'\r',
+    '"': u'"', "'": u"'", '/': u'/', '\\': u'\\'}
 
-escapeStrs = (('\n',r'\n'),('\b',r'\b'),
-    ('\f',r'\f'),('\t',r'\t'),('\r',r'\r'), ('"',r'\"')
-    )
+def unescapeReplace(match):
+    high, low, code, char = match.groups()
+    if char is not None:
+        # unknown escapes are kept as they are
+        return escapeChars.get(char, u'\\' + char)
+    if code is not None:
+        return unichr(int(code, 16))
+    high = int(high, 16)
+    low = int(low, 16)
+    try:
+        return unichr(0x10000 + ((high - 0xd800) << 10) + (low - 0xdc00))
+    except ValueError:
+        # narrow python build, keep the surrogate pair
+        return unichr(high) + unichr(low)
 
-class DictToken:
-    __slots__=[]
-    pass
-class ListToken:
-    __slots__=[]
-    pass
-class ColonToken:
-    __slots__=[]
-    pass
-class CommaToken:
-    __slots__=[]
-    pass
+def unescape(text):
+    return escapeRE.sub(unescapeReplace, text)
+
+class RecordType(object):
+    """the keys of Records and their positions"""
+    __slots__ = ('keys', 'index')
+
+    def __init__(self, keys):
+        self.keys = keys
+        self.index = dict((key, i) for i, key in enumerate(keys))
+
+    def __reduce__(self):
+        return RecordType, (self.keys,)
+
+class Record(object):
+    """a read only JSON object sharing its keys with the records of its type
+
+    Records behave like read only dicts. The reader makes them for the
+    objects in arrays if asked to, they take a fraction of the memory of a
+    dict.
+    """
+    __slots__ = ('_type', '_values')
+    __hash__ = None
+
+    def __init__(self, type, values):
+        self._type = type
+        self._values = values
+
+    def __getitem__(self, key):
+        return self._values[self._type.index[key]]
+
+    def get(self, key, default=None):
+        i = self._type.index.get(key)
+        if i is None:
+            return default
+        return self._values[i]
+
+    def __contains__(self, key):
+        return key in self._type.index
+
+    has_key = __contains__
+
+    def __len__(self):
+        return len(self._values)
+
+    def __iter__(self):
+        return iter(self._type.keys)
+
+    iterkeys = __iter__
+
+    def itervalues(self):
+        return iter(self._values)
+
+    def iteritems(self):
+        return zip(self._type.keys, self._values).__iter__()
+
+    def keys(self):
+        return list(self._type.keys)
+
+    def values(self):
+        return list(self._values)
+
+    def items(self):
+        return zip(self._type.keys, self._values)
+
+    def copy(self):
+        return dict(self.items())
+
+    def __eq__(self, other):
+        if isinstance(other, Record):
+            other = other.items()
+        elif not isinstance(other, dict):
+            return NotImplemented
+        return dict(self.items()) == dict(other)
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    def __repr__(self):
+        return 'Record(%r)' % self.copy()
+
+    def __reduce__(self):
+        # pickles share the type like the records do
+        return Record, (self._type, self._values)
+
+# at most this many distinct keys and record types are shared per parse
+internLimit = 10000
+
+# parser states, i.e. what we expect to see next
+VALUE = 0           # any value
+VALUE_OR_CLOSE = 1  # first item of a list or ']'
+KEY = 2             # a dict key
+KEY_OR_CLOSE = 3    # first key of a dict or '}'
+COLON = 4           # the ':' after a dict key
+COMMA_OR_CLOSE = 5  # ',' or the end of the current container
+DONE = 6            # top level value is complete
 
 class JSONReader(object):
-    """raise SyntaxError if it is not JSON, and make the object available"""
-    def __init__(self, data):
-        self.stop = False
-        #make an iterator of data so that next() works in tokenize.
-        self._data = iter([data])
-        self.lastOp = None
-        self.objects = []
-        self.tokenize()
-
-    def tokenize(self):
-        try:
-            tokenize(self._data.next,self.readTokens)
-        except TokenError:
-            raise SyntaxError
+    """raise SyntaxError if it is not JSON, and make the object available
 
-    def resolveList(self):
-        #check for empty list
-        if isinstance(self.objects[-1],ListToken):
-            self.objects[-1] = []
-            return
-        theList = []
-        commaCount = 0
-        try:
-            item = self.objects.pop()
-        except IndexError:
-            raise SyntaxError
-        while not isinstance(item,ListToken):
-            if isinstance(item,CommaToken):
-                commaCount += 1
-            else:
-                theList.append(item)
-            try:
-                item = self.objects.pop()
-            except IndexError:
-                raise SyntaxError
-        if not commaCount == (len(theList) -1):
-            raise SyntaxError
-        theList.reverse()
-        item = theList
-        self.objects.append(item)
-
-    def resolveDict(self):
-        theList = []
-        #check for empty dict
-        if isinstance(self.objects[-1], DictToken):
-            self.objects[-1] = {}
-            return
-        #not empty; must have at least three values
-        try:
-            #value (we're going backwards!)
-            value = self.objects.pop()
-        except IndexError:
-            raise SyntaxError
-        try:
-            #colon
-            colon = self.objects.pop()
-            if not isinstance(colon, ColonToken):
-                raise SyntaxError
-        except IndexError:
-            raise SyntaxError
-        try:
-            #key
-            key = self.objects.pop()
-            if not isinstance(key,basestring):
-                raise SyntaxError
-        except IndexError:
+    The data is scanned in one pass. Containers are kept on an explicit
+    stack, so nesting depth is not limited by the python recursion limit.
+    Byte data is scanned as it is if encoding is given, only the strings
+    in it are decoded.
+    Equal dict keys are the same string object. With records the objects in
+    arrays are read as Records.
+    """
+    # the encoding of byte data, None for unicode
+    encoding = None
 
-            raise SyntaxError
-        #salt the while
-        comma = value
-        while not isinstance(comma,DictToken):
-            # store the value
-            theList.append((key,value))
-            #do it again...
-            try:
-                #might be a comma
-                comma = self.objects.pop()
-            except IndexError:
-                raise SyntaxError
-            if isinstance(comma,CommaToken):
-                #if it's a comma, get the values
-                try:
-                    value = self.objects.pop()
-                except IndexError:
-                    #print self.objects
-                    raise SyntaxError
-                try:
-                    colon = self.objects.pop()
-                    if not isinstance(colon, ColonToken):
-                        raise SyntaxError
-                except IndexError:
-                    raise SyntaxError
-                try:
-                    key = self.objects.pop()
-                    if not isinstance(key,basestring):
-                        raise SyntaxError
-                except IndexError:
-                    raise SyntaxError
-        theDict = {}
-        for k in theList:
-            theDict[k[0]] = k[1]
-        self.objects.append(theDict)
-
-    def readTokens(self,type, token, (srow, scol), (erow, ecol), line):
-        # UPPERCASE consts from tokens.py or tokenize.py
-        if type == OP:
-            if token not in "[{}],:-":
-                raise SyntaxError
-            else:
-                self.lastOp = token
-            if token == '[':
-                self.objects.append(ListToken())
-            elif token == '{':
-                self.objects.append(DictToken())
-            elif token == ']':
-                self.resolveList()
-            elif token == '}':
-                self.resolveDict()
-            elif token == ':':
-                self.objects.append(ColonToken())
-            elif token == ',':
-                self.objects.append(CommaToken())
-        elif type == STRING:
-            tok = token[1:-1]
-            parts = tok.split("\\\\")
-            for k in escapeStrs:
-                if k[1] in tok:
-                    parts = [part.replace(k[1],k[0]) for part in parts]
-            self.objects.append("\\".join(parts))
-        elif type == NUMBER:
-            if self.lastOp == '-':
-                factor = -1
-            else:
-                factor = 1
-            try:
-                self.objects.append(factor * int(token))
-            except ValueError:
-                self.objects.append(factor * float(token))
-        elif type == NAME:
-            try:
-                self.objects.append({'true':True,
-                    'false':False,'null':None}[token])
-            except KeyError:
-                raise SyntaxError
-        elif type == ENDMARKER:
-            pass
-        elif type == NL:
-            pass
-        elif type == ERRORTOKEN:
-            if ecol == len(line):
-                #it's a char at the end of the line.  (mostly) harmless.
-                pass
-            else:
-                raise SyntaxError
+    def __init__(self, data, encoding=None, records=False):
+        self.stack = []
+        self.state = VALUE
+        self.key = None
+        self.result = None
+        self.encoding = encoding
+        self.keys = {}
+        # record types by keys, None if no records are made
+        self.records = {} if records else None
+        self.parse(data, 0, True)
+
+    def record(self, data):
+        """return the Record for a dict"""
+        keys = tuple(data)
+        recordType = self.records.get(keys)
+        if recordType is None:
+            recordType = RecordType(keys)
+            if len(self.records) < internLimit:
+                self.records[keys] = recordType
+        return Record(recordType, tuple(data.itervalues()))
+
+    def parse(self, s, pos, final):
+        """parse s starting at pos and return the position where we stopped
+
+        If final is False, parsing stops in front of a token which may be
+        continued by more data; if final is True, that is an error.
+        """
+        stack = self.stack
+        state = self.state
+        key = self.key
+        if stack:
+            container = stack[-1]
+            isdict = type(container) is dict
         else:
-            raise SyntaxError
+            container = None
+            isdict = False
+        skip = skipRE.match
+        dqstring = dqstringRE.match
+        sqstring = sqstringRE.match
+        keystring = keyRE.match
+        number = numberRE.match
+        encoding = self.encoding
+        keys = self.keys
+        records = self.records
+        end = len(s)
+        while 1:
+            if pos < end and s[pos] in skipChars:
+                pos = skip(s, pos).end()
+                if pos < end and s[pos] == '/':
+                    # unterminated comment
+                    if not final:
+                        break
+                    if s[pos:pos + 2] == '//':
+                        pos = end
+                    else:
+                        raise SyntaxError('Unterminated comment')
+            if pos >= end:
+                break
+            c = s[pos]
+
+            if state <= VALUE_OR_CLOSE:
+                # we expect a value
+                if c == '"':
+                    m = dqstring(s, pos)
+                    if m is None:
+                        if not final:
+                            break
+                        raise SyntaxError('Unterminated string')
+                    value = m.group(1)
+                    if encoding is not None:
+                        value = unicode(value, encoding)
+                    if '\\' in value:
+                        value = unescape(value)
+                    pos = m.end()
+                elif c in numberChars:
+                    m = number(s, pos)
+                    if m is None:
+                        if not final and pos + 1 == end:
+                            break
+                        raise SyntaxError('Invalid number')
+                    pos = m.end()
+                    if not final and (pos == end or end - pos <= 2 and
+                                      s[pos:] in partialExponents):
+                        # the number may go on in the next chunk
+                        pos = m.start()
+                        break
+                    if m.lastindex == 1:
+                        value = int(m.group(1))
+                    else:
+                        value = float(m.group())
+                elif c == '{' or c == '[':
+                    pos += 1
+                    if c == '{':
+                        value = {}
+                        state = KEY_OR_CLOSE
+                    else:
+                        value = []
+                        state = VALUE_OR_CLOSE
+                    if isdict:
+                        container[key] = value
+                    elif container is not None:
+                        container.append(value)
+                    else:
+                        self.result = value
+                    stack.append(value)
+                    container = value
+                    isdict = c == '{'
+                    continue
+                elif c == ']' and state == VALUE_OR_CLOSE:
+                    pos += 1
+                    stack.pop()
+                    if stack:
+                        container = stack[-1]
+                        isdict = type(container) is dict
+                        state = COMMA_OR_CLOSE
+                    else:
+                        container = None
+                        state = DONE
+                    continue
+                elif c in literals:
+                    word, value = literals[c]
+                    if s[pos:pos + len(word)] != word:
+                        if not final and word.startswith(s[pos:]):
+                            break
+                        raise SyntaxError('Unknown literal')
+                    pos += len(word)
+                elif c == "'":
+                    m = sqstring(s, pos)
+                    if m is None:
+                        if not final:
+                            break
+                        raise SyntaxError('Unterminated string')
+                    value = m.group(1)
+                    if encoding is not None:
+                        value = unicode(value, encoding)
+                    if '\\' in value:
+                        value = unescape(value)
+                    pos = m.end()
+                else:
+                    raise SyntaxError('Unexpected character %r' % c)
+
+                # store the scalar value we've just read
+                if isdict:
+                    container[key] = value
+                elif container is not None:
+                    container.append(value)
+                else:
+                    self.result = value
+                    state = DONE
+                    continue
+                # fast path: a comma directly after the value
+                if pos < end and s[pos] == ',':
+                    pos += 1
+                    state = KEY if isdict else VALUE
+                else:
+                    state = COMMA_OR_CLOSE
+
+            elif state == COMMA_OR_CLOSE:
+                if c == ',':
+                    pos += 1
+                    state = KEY if isdict else VALUE
+                elif c == ('}' if isdict else ']'):
+                    pos += 1
+                    value = stack.pop()
+                    if stack:
+                        container = stack[-1]
+                        if records is not None and isdict and (
+                                type(container) is list):
+                            container[-1] = self.record(value)
+                        isdict = type(container) is dict
+                    else:
+                        container = None
+                        state = DONE
+                else:
+                    raise SyntaxError('Expecting , or end of container')
+
+            elif state <= KEY_OR_CLOSE:
+                if c == '"':
+                    # fast path: the key directly followed by its colon
+                    m = keystring(s, pos)
+                    if m is not None:
+                        key = m.group(1)
+                        if encoding is not None:
+                            key = unicode(key, encoding)
+                        if '\\' in key:
+                            key = unescape(key)
+                        interned = keys.get(key)
+                        if interned is not None:
+                            key = interned
+                        elif len(keys) < internLimit:
+                            keys[key] = key
+                        pos = m.end()
+                        state = VALUE
+                        continue
+                if c == '"' or c == "'":
+                    m = (dqstring if c == '"' else sqstring)(s, pos)
+                    if m is None:
+                        if not final:
+                            break
+                        raise SyntaxError('Unterminated string')
+                    key = m.group(1)
+                    if encoding is not None:
+                        key = unicode(key, encoding)
+                    if '\\' in key:
+                        key = unescape(key)
+                    interned = keys.get(key)
+                    if interned is not None:
+                        key = interned
+                    elif len(keys) < internLimit:
+                        keys[key] = key
+                    pos = m.end()
+                    state = COLON
+                elif c == '}' and state == KEY_OR_CLOSE:
+                    pos += 1
+                    value = stack.pop()
+                    if stack:
+                        container = stack[-1]
+                        isdict = type(container) is dict
+                        if records is not None and not isdict:
+                            container[-1] = self.record(value)
+                        state = COMMA_OR_CLOSE
+                    else:
+                        container = None
+                        state = DONE
+                else:
+                    raise SyntaxError('Expecting a string as dict key')
+
+            elif state == COLON:
+                if c != ':':
+                    raise SyntaxError('Expecting :')
+                pos += 1
+                state = VALUE
+
+            else:
+                # Konqueror appends a trailing null
+                if c != '\x00':
+                    raise SyntaxError('Extra data after JSON expression')
+                pos += 1
+
+        self.state = state
+        self.key = key
+        if final and state != DONE:
+            raise SyntaxError('Unexpected end of JSON expression')
+        return pos
+
     def output(self):
-        try:
-            assert len(self.objects) == 1
-        except AssertionError:
+        if self.state != DONE:
             raise SyntaxError
-        return self.objects[0]
+        return self.result
 
-def safeRead(aString, encoding=None):
-    """read the js, first sanitizing a bit and removing any c-style comments
+# encodings in which the JSON syntax is plain ASCII and other characters
+# never contain ASCII bytes, byte data in them is scanned without decoding
+asciiCompatible = frozenset(['utf-8', 'ascii', 'iso8859-1'])
+
+def isAsciiCompatible(encoding):
+    try:
+        return codecs.lookup(encoding).name in asciiCompatible
+    except LookupError:
+        return False
+
+def safeRead(aString, encoding=None, records=False):
+    """read the js, ignoring any c-style comments
     If the input is a unicode string, great.  That's preferred.  If the input 
     is a byte string, strings in the object will be produced as unicode anyway.
+
+    Byte strings, bytearrays, memoryviews and mmaps in UTF-8 or an other
+    ASCII compatible encoding are parsed without decoding them as a whole,
+    only the strings in them are decoded. A memoryview is copied once, the
+    regular expressions of python 2 can't scan it.
+
+    With records the objects in arrays are read as Records.
     """
-    # get rid of trailing null. Konqueror appends this.
-    CHR0 = chr(0)
-    while aString.endswith(CHR0):
-        aString = aString[:-1]
-    # strip leading and trailing whitespace
-    aString = aString.strip()
-    # zap /* ... */ comments
-    aString = slashstarcomment.sub('',aString)
-    # zap // comments
-    aString = doubleslashcomment.sub('',aString)
-    # detect and handle \\u unicode characters. Note: This has the side effect
-    # of converting the entire string to unicode. This is probably OK.
-    unicodechars = unichrRE.search(aString)
-    if unicodechars:
-        aString = unichrRE.sub(unichrReplace, aString)
     #if it's already unicode, we won't try to decode it
     if isinstance(aString, unicode):
         s = aString
+        encoding = None
+    elif isAsciiCompatible(encoding or emergencyEncoding):
+        encoding = encoding or emergencyEncoding
+        if isinstance(aString, memoryview):
+            s = aString.tobytes()
+        elif isinstance(aString, str):
+            s = aString
+        else:
+            # bytearray, mmap or buffer, indexing and slicing a buffer
+            # returns strings like for str
+            s = buffer(aString)
     else:
+        if isinstance(aString, memoryview):
+            aString = aString.tobytes()
+        elif not isinstance(aString, str):
+            aString = str(buffer(aString))
         if encoding:
             # note: no "try" here.  the encoding provided must work for the
             # incoming byte string.  UnicodeDecode error will be raised
             # in that case.  Often, it will be best not to provide the encoding
             # and allow the default
             s = unicode(aString, encoding)
-            #print "decoded %s from %s" % (s,encoding)
         else:
             # let's try to decode to unicode in system default encoding
             try:
                 s = unicode(aString)
-                #import sys
-                #print "decoded %s from %s" % (s,sys.getdefaultencoding())
             except UnicodeDecodeError:
                 # last choice: handle as emergencyEncoding
                 enc = emergencyEncoding
                 s = unicode(aString, enc)
-                #print "%s decoded from %s" % (s, enc)
+        encoding = None
     # parse and get the object.
     try:
-        data = JSONReader(s).output()
+        data = JSONReader(s, encoding, records).output()
     except SyntaxError:
-        raise ReadException, 'Unacceptable JSON expression: %s' % aString
+        raise ReadException, 'Unacceptable JSON expression: %s' % s[:80]
     return data
 
 read = safeRead
 
+class JSONParser(JSONReader):
+    """incremental JSON reader
+
+    Feed the data in chunks as it arrives and call close() to get the
+    object. Parsing happens while feeding, only a token split between two
+    chunks is kept back until the next chunk arrives.
+    Byte strings are decoded with the given encoding or emergencyEncoding.
+    With records the objects in arrays are read as Records.
+    """
+    def __init__(self, encoding=None, records=False):
+        self.stack = []
+        self.state = VALUE
+        self.key = None
+        self.result = None
+        self.keys = {}
+        self.records = {} if records else None
+        self.decoder = codecs.getincrementaldecoder(
+            encoding or emergencyEncoding)()
+        self.pending = []
+        self.pendingSize = 0
+        # a token split between chunks is scanned again from its start,
+        # wait until the pending data doubled to keep that linear
+        self.needed = 0
+
+    def feed(self, data):
+        if not isinstance(data, unicode):
+            data = self.decoder.decode(data)
+        if not data:
+            return
+        self.pending.append(data)
+        self.pendingSize += len(data)
+        if self.pendingSize > self.needed:
+            self._parse(False)
+
+    def _parse(self, final):
+        s = u''.join(self.pending)
+        try:
+            pos = self.parse(s, 0, final)
+        except SyntaxError:
+            raise ReadException, 'Unacceptable JSON expression: %s' % s[:80]
+        rest = s[pos:]
+        if rest:
+            self.pending = [rest]
+        else:
+            self.pending = []
+        self.pendingSize = len(rest)
+        self.needed = 2 * len(rest)
+
+    def close(self):
+        """finish parsing and return the object"""
+        self.pending.append(self.decoder.decode('', True))
+        self._parse(True)
+        return self.result
+
+def mapFile(fileobj):
+    """return a read only mmap of a regular file or None"""
+    try:
+        fileno = fileobj.fileno()
+    except (AttributeError, IOError, ValueError):
+        # no real file, e.g. a StringIO
+        return None
+    info = os.fstat(fileno)
+    if not stat.S_ISREG(info.st_mode) or not info.st_size:
+        return None
+    try:
+        return mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
+    except (EnvironmentError, mmap.error):
+        return None
+
+def load(fileobj, encoding=None, bufsize=65536, records=False):
+    """read the JSON document from the current position of fileobj
+
+    A regular file is memory mapped and parsed in place, other file objects
+    are read in chunks of bufsize and parsed while reading.
+    """
+    data = mapFile(fileobj)
+    if data is not None:
+        try:
+            result = safeRead(buffer(data, fileobj.tell()), encoding, records)
+        finally:
+            data.close()
+        fileobj.seek(0, 2)
+        return result
+    parser = JSONParser(encoding, records)
+    read = fileobj.read
+    while 1:
+        chunk = read(bufsize)
+        if not chunk:
+            break
+        parser.feed(chunk)
+    return parser.close()
+
+#################################
+#   stream JSON events          #
+#################################
+
+punctuation = '{}[],:\x00'
+
+def iterTokens(fileobj, encoding=None, bufsize=65536):
+    """yield (token, value) pairs read from fileobj
+
+    Punctuation is its own token with a None value, everything else is
+    one of 'string', 'number', 'boolean' or 'null'. Only the current
+    buffer of bufsize characters is held in memory.
+    """
+    read = fileobj.read
+    decoder = codecs.getincrementaldecoder(encoding or emergencyEncoding)()
+    skip = skipRE.match
+    dqstring = dqstringRE.match
+    sqstring = sqstringRE.match
+    number = numberRE.match
+    s = u''
+    pos = end = 0
+    eof = False
+    while 1:
+        more = False
+        if pos < end and s[pos] in skipChars:
+            pos = skip(s, pos).end()
+            if pos < end and s[pos] == '/':
+                if not eof:
+                    more = True
+                elif s.startswith('//', pos):
+                    pos = end
+                else:
+                    raise ReadException, 'Unterminated comment'
+        if pos < end and not more:
+            c = s[pos]
+            if c in punctuation:
+                pos += 1
+                yield c, None
+                continue
+            elif c == '"' or c == "'":
+                m = (dqstring if c == '"' else sqstring)(s, pos)
+                if m is not None:
+                    value = m.group(1)
+                    if '\\' in value:
+                        value = unescape(value)
+                    pos = m.end()
+                    yield 'string', value
+                    continue
+                elif eof:
+                    raise ReadException, 'Unterminated string'
+            elif c in numberChars:
+                m = number(s, pos)
+                if m is not None and (eof or m.end() < end and
+                        s[m.end():m.end() + 2] not in partialExponents):
+                    pos = m.end()
+                    if m.lastindex == 1:
+                        yield 'number', int(m.group(1))
+                    else:
+                        yield 'number', float(m.group())
+                    continue
+                elif eof or m is None and pos + 1 < end:
+                    raise ReadException, 'Invalid number'
+            elif c in literals:
+                word, value = literals[c]
+                if s.startswith(word, pos):
+                    pos += len(word)
+                    if value is None:
+                        yield 'null', None
+                    else:
+                        yield 'boolean', value
+                    continue
+                elif eof or not word.startswith(s[pos:pos + len(word)]):
+                    raise ReadException, 'Unknown literal'
+            else:
+                raise ReadException, 'Unexpected character %r' % c
+        # we need more data to go on, wait until the pending data doubled
+        # to keep tokens longer than bufsize linear
+        if eof:
+            break
+        pending = [s[pos:]]
+        size = end - pos
+        needed = 2 * size
+        while size <= needed:
+            data = read(bufsize)
+            if data:
+                if not isinstance(data, unicode):
+                    data = decoder.decode(data)
+            else:
+                eof = True
+                data = decoder.decode('', True)
+            pending.append(data)
+            size += len(data)
+            if eof:
+                break
+        s = u''.join(pending)
+        pos = 0
+        end = len(s)
+
+def iterparse(fileobj, encoding=None, bufsize=65536):
+    """yield (prefix, event, value) for the JSON document in fileobj
+
+    The events are start_map, map_key, end_map, start_array, end_array,
+    string, number, boolean and null. prefix is the dotted path of the
+    value: map keys are added by name, array items as 'item'.
+    Raise ReadException if it is not JSON.
+    """
+    stack = []
+    prefix = ''
+    state = VALUE
+    for token, value in iterTokens(fileobj, encoding, bufsize):
+        if state <= VALUE_OR_CLOSE:
+            if token == '{':
+                yield prefix, 'start_map', None
+                stack.append((True, prefix))
+                state = KEY_OR_CLOSE
+                continue
+            elif token == '[':
+                yield prefix, 'start_array', None
+                stack.append((False, prefix))
+                prefix = prefix and prefix + '.item' or 'item'
+                state = VALUE_OR_CLOSE
+                continue
+            elif token == ']' and state == VALUE_OR_CLOSE:
+                isdict, prefix = stack.pop()
+                yield prefix, 'end_array', None
+            elif token in punctuation:
+                raise ReadException, 'Unexpected %r' % token
+            else:
+                yield prefix, token, value
+        elif state == COMMA_OR_CLOSE:
+            isdict, parent = stack[-1]
+            if token == ',':
+                state = isdict and KEY or VALUE
+                continue
+            elif token == (isdict and '}' or ']'):
+                stack.pop()
+                prefix = parent
+                yield prefix, isdict and 'end_map' or 'end_array', None
+            else:
+                raise ReadException, 'Expecting , or end of container'
+        elif state <= KEY_OR_CLOSE:
+            parent = stack[-1][1]
+            if token == 'string':
+                yield parent, 'map_key', value
+                prefix = parent and parent + '.' + value or value
+                state = COLON
+                continue
+            elif token == '}' and state == KEY_OR_CLOSE:
+                stack.pop()
+                prefix = parent
+                yield prefix, 'end_map', None
+            else:
+                raise ReadException, 'Expecting a string as dict key'
+        elif state == COLON:
+            if token != ':':
+                raise ReadException, 'Expecting :'
+            state = VALUE
+            continue
+        else:
+            # Konqueror appends a trailing null
+            if token != '\x00':
+                raise ReadException, 'Extra data after JSON expression'
+            continue
+        # a value is complete
+        if stack:
+            state = COMMA_OR_CLOSE
+        else:
+            state = DONE
+    if state != DONE:
+        raise ReadException, 'Unexpected end of JSON expression'
+
+def items(fileobj, prefix='item', encoding=None, bufsize=65536):
+    """yield the values found at prefix in the JSON document in fileobj
+
+    With the default prefix these are the items of a top level array;
+    use e.g. 'result.item' for the items of the array in a result key.
+    Only one item is built in memory at a time.
+    """
+    events = iterparse(fileobj, encoding, bufsize)
+    for current, event, value in events:
+        if current != prefix:
+            continue
+        if event == 'start_map' or event == 'start_array':
+            yield buildObject(event, events)
+        elif event not in ('map_key', 'end_map', 'end_array'):
+            yield value
+
+def buildObject(event, events):
+    """build the container started by event from the following events"""
+    if event == 'start_map':
+        root = {}
+    else:
+        root = []
+    stack = [root]
+    key = None
+    for prefix, event, value in events:
+        if event == 'map_key':
+            key = value
+            continue
+        if event == 'end_map' or event == 'end_array':
+            stack.pop()
+            if not stack:
+                return root
+            continue
+        if event == 'start_map':
+            value = {}
+        elif event == 'start_array':
+            value = []
+        container = stack[-1]
+        if type(container) is dict:
+            container[key] = value
+        else:
+            container.append(value)
+        if event == 'start_map' or event == 'start_array':
+            stack.append(value)
+    raise ReadException, 'Unexpected end of JSON expression'
+
 #################################
 #   write object as JSON        #
 #################################
 
-import re, codecs
+import re
 from cStringIO import StringIO
 
 ### Codec error handler
@@ -339,21 +871,38 @@ def write(input, encoding='utf-8', outputEncoding=None):
     writer.write(input)
     return writer.getvalue()
 
+def dump(input, fileobj, encoding='utf-8', outputEncoding='utf-8'):
+    """write input to fileobj as it is encoded, in outputEncoding"""
+    writer = JsonWriter(fileobj, input_encoding=encoding,
+                        output_encoding=outputEncoding)
+    writer.write(input)
+
 re_strmangle = re.compile('"|\b|\f|\n|\r|\t|\\\\')
 
+# the backslash must come first, it is part of the other replacements
+strmangleTable = (
+    ('\\', '\\\\'),
+    ('"', '\\"'),
+    ('\n', '\\n'),
+    ('\r', '\\r'),
+    ('\t', '\\t'),
+    ('\b', '\\b'),
+    ('\f', '\\f'),
+    )
+
+strmangleMap = dict(strmangleTable)
+
 def func_strmangle(match):
-    return {
-        '"': '\\"',
-        '\b': '\\b',
-        '\f': '\\f',
-        '\n': '\\n',
-        '\r': '\\r',
-        '\t': '\\t',
-        '\\': '\\\\',
-        }[match.group(0)]
-
-def strmangle(text):
-    return re_strmangle.sub(func_strmangle, text)
+    return strmangleMap[match.group(0)]
+
+def strmangle(text, search=re_strmangle.search):
+    # most strings don't need any escaping
+    if search(text) is None:
+        return text
+    for char, escaped in strmangleTable:
+        if char in text:
+            text = text.replace(char, escaped)
+    return text
 
 class JsonStream(object):
 
@@ -363,6 +912,9 @@ class JsonStream(object):
     def write(self, text):
         self.buf.append(text)
 
+    def writelines(self, texts):
+        self.buf.extend(texts)
+
     def getvalue(self):
         return ''.join(self.buf)
 
@@ -384,41 +936,28 @@ class JsonWriter(object):
         self.output_encoding = output_encoding
 
     def write(self, obj):
-        if isinstance(obj, (list, tuple)):
-            self.stream.write('[')
-            first = True
-            for elem in obj:
-                if first:
-                    first = False
-                else:
-                    self.stream.write(',')
-                self.write(elem)
-            self.stream.write(']'),
-        elif isinstance(obj, dict):
-            self.stream.write('{')
-            first = True
-            for key, value in obj.iteritems():
-                if first:
-                    first = False
-                else:
-                    self.stream.write(',')
-                self.write(key)
-                self.stream.write(':')
-                self.write(value)
-            self.stream.write('}')
-        elif obj is True:
-            self.stream.write('true')
+        writelines = getattr(self.stream, 'writelines', None)
+        if writelines is not None:
+            writelines(self.iterwrite(obj))
+        else:
+            write = self.stream.write
+            for fragment in self.iterwrite(obj):
+                write(fragment)
+
+    def encodeScalar(self, obj):
+        """return the JSON text for anything but a list, tuple or dict"""
+        if obj is True:
+            return 'true'
         elif obj is False:
-            self.stream.write('false')
+            return 'false'
         elif obj is None:
-            self.stream.write('null')
+            return 'null'
         elif not isinstance(obj, basestring):
             # if we are not baseobj, convert to it
             try:
-                obj = str(obj)
+                return str(obj)
             except Exception, exc:
                 raise WriteException, 'Cannot write object (%s: %s)' % (exc.__class__, exc)
-            self.stream.write(obj)
         else:
             # convert to unicode first
             if not isinstance(obj, unicode):
@@ -427,15 +966,82 @@ class JsonWriter(object):
                 except (UnicodeDecodeError, UnicodeTranslateError):
                     obj = unicode(obj, 'utf-8', 'replace')
             # do the mangling
-            obj = strmangle(obj)
+            obj = '"' + strmangle(obj) + '"'
             # make the encoding
             if self.output_encoding is not None:
                 obj = obj.encode(self.output_encoding, 'jsonreplace')
-            self.stream.write('"')
-            self.stream.write(obj)
-            self.stream.write('"')
+            return obj
 
-    def getvalue(self):
-        return self.stream.getvalue()
+    def iterwrite(self, obj):
+        """yield the JSON text for obj in fragments
 
+        Open containers are kept on an explicit stack, so the nesting depth
+        is not limited by the python recursion limit.
+        """
+        encodeScalar = self.encodeScalar
+        end = object()
+        # iterators over the open containers with their closing bracket
+        stack = []
+        while 1:
+            kind = type(obj)
+            if kind is list or kind is tuple or (kind is not dict and
+                    isinstance(obj, (list, tuple))):
+                yield '['
+                stack.append((iter(obj), ']', False))
+                first = True
+            elif kind is dict or isinstance(obj, (dict, Record)):
+                yield '{'
+                stack.append((obj.iteritems(), '}', True))
+                first = True
+            else:
+                yield encodeScalar(obj)
+                first = False
+            # find the next value to write
+            while stack:
+                items, closer, isdict = stack[-1]
+                item = next(items, end)
+                if item is end:
+                    stack.pop()
+                    yield closer
+                    first = False
+                    continue
+                if isdict:
+                    key, obj = item
+                    if first:
+                        yield encodeScalar(key) + ':'
+                    else:
+                        yield ',' + encodeScalar(key) + ':'
+                elif not first:
+                    obj = item
+                    yield ','
+                else:
+                    obj = item
+                break
+            else:
+                return
 
+    def iterencode(self, obj, chunk_size=65536):
+        """yield the JSON text for obj in chunks of chunk_size
+
+        Only the last chunk may be shorter. The chunks are encoded in
+        output_encoding, or unicode if no output_encoding is given. The
+        stream is not used.
+        """
+        buf = []
+        size = 0
+        for fragment in self.iterwrite(obj):
+            buf.append(fragment)
+            size += len(fragment)
+            if size >= chunk_size:
+                data = ''.join(buf)
+                pos = 0
+                while size - pos >= chunk_size:
+                    yield data[pos:pos + chunk_size]
+                    pos += chunk_size
+                buf = [data[pos:]]
+                size -= pos
+        if size:
+            yield ''.join(buf)
+
+    def getvalue(self):
+        return self.stream.getvalue()
@@ -0,0 +1,140 @@
+##############################################################################
+#
+# Copyright (c) 2007 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Newline delimited JSON (JSON Lines)
+
+One JSON document per line, in UTF-8. Blank lines are skipped.
+
+$Id:$
+"""
+__docformat__ = "reStructuredText"
+
+import multiprocessing
+import os
+
+from z3c.json import converter
+
+# files smaller than this are not worth a process pool
+minParallelSize = 1 << 20
+
+
+def iterload(fileobj, reader=None):
+    """Yield the documents in fileobj, one per line
+
+    reader is a converter.JSONReader, a new one with the default backend
+    if not given. It raises ResponseError for a line it can't read.
+    """
+    if reader is None:
+        reader = converter.JSONReader()
+    read = reader.read
+    for line in fileobj:
+        if line.strip():
+            yield read(line, 'utf-8')
+
+
+def load(fileobj, reader=None):
+    """Return the list of the documents in fileobj"""
+    return list(iterload(fileobj, reader))
+
+
+def dump(documents, fileobj, writer=None):
+    """Write the documents to fileobj, one per line
+
+    writer is a converter.JSONWriter, a new one with the default backend
+    if not given.
+    """
+    if writer is None:
+        writer = converter.JSONWriter()
+    write = writer.write
+    fileobj.writelines(write(document).encode('utf-8') + '\n'
+                       for document in documents)
+
+
+def splitRanges(fileobj, size, chunkSize):
+    """Return (start, end) byte ranges of about chunkSize in fileobj
+
+    The ranges start at the beginning of a line.
+    """
+    ranges = []
+    start = 0
+    while start < size:
+        end = start + chunkSize
+        if end >= size:
+            end = size
+        else:
+            # move the end behind the line it falls into, a line starting
+            # right at end stays in the next range
+            fileobj.seek(end - 1)
+            fileobj.readline()
+            end = fileobj.tell()
+        ranges.append((start, end))
+        start = end
+    return ranges
+
+
+def loadRange(args):
+    """Return the documents in a byte range of a file, run in a worker"""
+    filename, start, end, backend = args
+    f = open(filename, 'rb')
+    try:
+        f.seek(start)
+        data = f.read(end - start)
+    finally:
+        f.close()
+    reader = converter.JSONReader(backend)
+    return [reader.read(line, 'utf-8')
+            for line in data.splitlines() if line.strip()]
+
+
+def parallelIterload(filename, backend=None, processes=None,
+                     chunkSize=4 << 20):
+    """Yield the documents in the file, parsed on a pool of processes
+
+    The file is split into byte ranges of about chunkSize at line
+    boundaries, the ranges are parsed by processes workers, by default one
+    per CPU, and their documents are yielded in the order of the file.
+    Files smaller than minParallelSize are read in this process.
+    """
+    size = os.path.getsize(filename)
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    if processes < 2 or size < minParallelSize:
+        f = open(filename, 'rb')
+        try:
+            reader = converter.JSONReader(backend)
+            for document in iterload(f, reader):
+                yield document
+        finally:
+            f.close()
+        return
+
+    f = open(filename, 'rb')
+    try:
+        ranges = splitRanges(f, size, chunkSize)
+    finally:
+        f.close()
+    pool = multiprocessing.Pool(processes)
+    try:
+        results = pool.imap(loadRange, [(filename, start, end, backend)
+                                        for start, end in ranges])
+        for documents in results:
+            for document in documents:
+                yield document
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def parallelLoad(filename, backend=None, processes=None, chunkSize=4 << 20):
+    """Return the list of the documents in the file, see parallelIterload"""
+    return list(parallelIterload(filename, backend, processes, chunkSize))
@@ -0,0 +1,154 @@
+##############################################################################
+#
+# Copyright (c) 2007 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Parallel reading of huge top-level JSON arrays
+
+The array is scanned for the boundaries of its items, the items are parsed
+in ranges on a pool of processes and joined in order.
+
+$Id:$
+"""
+__docformat__ = "reStructuredText"
+
+import multiprocessing
+import re
+import sys
+
+from z3c.json import minjson
+
+# inputs smaller than this are not worth a process pool
+minParallelSize = 1 << 20
+
+# everything up to the next bracket, strings included; quotes and slashes
+# outside strings mean minjson syntax, a lone " an unterminated string
+skipRE = re.compile(r'(?:[^"\[\]{}\'/]+|"[^"\\]*(?:\\.[^"\\]*)*")*'
+                    r'([\[\]{}\'/"]|\Z)')
+spaceRE = re.compile(r'[ \t\n\r]*')
+commaRE = re.compile(r'[ \t\n\r]*,')
+
+# the workers inherit the data from a forked process, it can't be pickled
+# for a spawned one
+canFork = sys.platform != 'win32'
+
+
+def splitArray(data, chunkSize):
+    """Return (start, end) ranges of about chunkSize holding whole items
+
+    data must be a top-level array in strict JSON. The ranges don't
+    include the brackets or the commas between them. They are cut behind
+    lists and dicts in the array, an array of scalars is one range. Return
+    None if data is anything else, minjson will find out.
+    """
+    skip = skipRE.match
+    pos = spaceRE.match(data).end()
+    if data[pos:pos + 1] != '[':
+        return None
+    ranges = []
+    pos += 1
+    start = pos
+    depth = 1
+    while 1:
+        match = skip(data, pos)
+        c = match.group(1)
+        pos = match.end()
+        if c == '[' or c == '{':
+            depth += 1
+        elif c == ']' or c == '}':
+            depth -= 1
+            if depth == 0:
+                end = pos - 1
+                break
+            if depth == 1 and pos - start >= chunkSize:
+                match = commaRE.match(data, pos)
+                if match is not None:
+                    ranges.append((start, pos))
+                    start = pos = match.end()
+        else:
+            # the end, a single quoted string, a comment or an unterminated
+            # string
+            return None
+    # only whitespace and Konqueror's trailing NULs may follow
+    rest = data[spaceRE.match(data, end + 1).end():]
+    if rest.strip('\x00'):
+        return None
+    if ranges and spaceRE.match(data, start).end() == end:
+        # a comma before the closing bracket
+        return None
+    ranges.append((start, end))
+    return ranges
+
+
+def initWorker(data, encoding):
+    """Keep the data to read in a pool process"""
+    global _data, _encoding
+    _data = data
+    _encoding = encoding
+
+
+def readRange(bounds):
+    """Return the items in a range of the data, run in a pool process"""
+    start, end = bounds
+    return minjson.read('[' + _data[start:end] + ']', _encoding)
+
+
+def parallelRead(data, encoding=None, processes=None, chunkSize=4 << 20):
+    """Read a top-level JSON array with a pool of processes
+
+    data is a string, bytearray, buffer or mmap. It is split into ranges of
+    about chunkSize bytes at item boundaries, processes workers (by default
+    one per CPU) parse them and the items are joined in order. Data smaller
+    than minParallelSize, in minjson syntax or not an array is read in this
+    process by minjson.read, as is everything where processes can't fork.
+    """
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    if isinstance(data, bytearray):
+        data = buffer(data)
+    if (not canFork or processes < 2 or len(data) < minParallelSize or
+        not isinstance(data, unicode) and
+        not minjson.isAsciiCompatible(encoding or minjson.emergencyEncoding)):
+        return minjson.read(data, encoding)
+    ranges = splitArray(data, chunkSize)
+    if ranges is None or len(ranges) < 2:
+        return minjson.read(data, encoding)
+
+    # initargs go to the forked processes, also to replaced ones, without
+    # being pickled
+    pool = multiprocessing.Pool(min(processes, len(ranges)), initWorker,
+                                (data, encoding))
+    try:
+        result = []
+        for items in pool.imap(readRange, ranges):
+            result.extend(items)
+    finally:
+        pool.terminate()
+        pool.join()
+    return result
+
+
+def parallelLoad(filename, encoding=None, processes=None, chunkSize=4 << 20):
+    """Read the top-level JSON array in a file, see parallelRead
+
+    The file is memory mapped and shared with the workers.
+    """
+    f = open(filename, 'rb')
+    try:
+        data = minjson.mapFile(f)
+        if data is None:
+            return minjson.load(f, encoding)
+        try:
+            return parallelRead(data, encoding, processes, chunkSize)
+        finally:
+            data.close()
+    finally:
+        f.close()
@@ -18,14 +18,20 @@ __docformat__ = "reStructuredText"
 
 import urllib
 import copy
+import itertools
 import logging
 import socket
+import threading
+import time
+from collections import OrderedDict
 
 import zope.component
 from z3c.json import interfaces
 from z3c.json.exceptions import ProtocolError
 from z3c.json.exceptions import ResponseError
 
+from z3c.json.transport import AsyncTransport
+from z3c.json.transport import Future
 from z3c.json.transport import Transport
 from z3c.json.transport import SafeTransport
 
@@ -33,6 +39,18 @@ logger = logging.getLogger(__name__)
 JSON_RPC_VERSION = '2.0'
 
 
+class IdGenerator(object):
+    """Unique ids for calls, prefix.1, prefix.2, ..."""
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self._counter = itertools.count(1)
+
+    def __call__(self):
+        # count.next is atomic, ids are unique across threads
+        return u'%s.%d' % (self.prefix, self._counter.next())
+
+
 class _Method(object):
 
     def __init__(self, call, name, jsonId, jsonVersion):
@@ -42,6 +60,15 @@ class _Method(object):
         self.jsonVersion = jsonVersion
 
     def __call__(self, *args, **kwargs):
+        request = self._request(*args, **kwargs)
+        json = zope.component.getUtility(interfaces.IJSONWriter)
+        data = json.write(request)
+        try:
+            return self.call(data, request.get('id'))
+        except socket.error, msg:
+            raise ResponseError("JSONRPC server connection error.")
+
+    def _request(self, *args, **kwargs):
         request = {}
         # add our version
         if self.jsonVersion == '1.0':
@@ -81,25 +108,178 @@ class _Method(object):
 
         # set params and write json
         request['params'] = params
-        # add our json id
-        request['id'] = self.jsonId
-        json = zope.component.getUtility(interfaces.IJSONWriter)
-        data = json.write(request)
+        # add our json id, a generated one if we have an IdGenerator
+        if callable(self.jsonId):
+            request['id'] = self.jsonId()
+        else:
+            request['id'] = self.jsonId
+        return request
+
+    def __getattr__(self, name):
+        return self.__class__(self.call, "%s.%s" % (self.name, name),
+            self.jsonId, self.jsonVersion)
+
+
+class _BatchMethod(_Method):
+
+    def __call__(self, *args, **kwargs):
+        # the batch collects the request and returns its BatchResult
+        return self.call(self._request(*args, **kwargs))
+
+
+_missing = object()
+
+
+class _CachedMethod(_Method):
+
+    def __init__(self, call, name, jsonId, jsonVersion, cache, endpoint):
+        super(_CachedMethod, self).__init__(call, name, jsonId, jsonVersion)
+        self.cache = cache
+        self.endpoint = endpoint
+
+    def __call__(self, *args, **kwargs):
+        if self.name not in self.cache.methods:
+            return super(_CachedMethod, self).__call__(*args, **kwargs)
         try:
-            return self.call(data)
-        except socket.error, msg:
-            raise ResponseError("JSONRPC server connection error.")
+            key = self.cache.key(self.name, args or kwargs, self.endpoint)
+        except TypeError:
+            # params without a canonical form are not cached
+            return super(_CachedMethod, self).__call__(*args, **kwargs)
+        result = self.cache.get(key, _missing)
+        if result is _missing:
+            result = super(_CachedMethod, self).__call__(*args, **kwargs)
+            self.cache.set(key, result)
+            if isinstance(result, Future):
+                # don't keep failed asynchronous calls
+                def discardFailed(future):
+                    if future.exception() is not None:
+                        self.cache.discard(key)
+                result.addCallback(discardFailed)
+        return result
 
     def __getattr__(self, name):
-        return _Method(self.call, "%s.%s" % (self.name, name), self.jsonId,
-            self.jsonVersion)
+        return self.__class__(self.call, "%s.%s" % (self.name, name),
+            self.jsonId, self.jsonVersion, self.cache, self.endpoint)
+
+
+def canonical(params):
+    """Return a hashable form of JSON params, equal for equal JSON
+
+    Dicts compare regardless of their order, raises TypeError for other
+    than JSON types.
+    """
+    if isinstance(params, dict):
+        return ('{', tuple(sorted((key, canonical(value))
+                                  for key, value in params.iteritems())))
+    if isinstance(params, (list, tuple)):
+        return ('[', tuple(canonical(value) for value in params))
+    if isinstance(params, bool) or params is None:
+        # True == 1 in python, not in JSON
+        return ('b', params)
+    if isinstance(params, (basestring, int, long, float)):
+        return params
+    raise TypeError("Can't cache calls with %r" % params)
+
+
+class ResultCache(object):
+    """Results of calls to cacheable remote methods.
+
+    Results of the methods named in methods are kept for ttl seconds (None
+    keeps them until they are evicted), at most maxsize of them. The least
+    recently used result is evicted first. Cached results are shared by
+    all callers, don't modify them. A cache may be shared by threads and
+    proxies, results are kept apart by the endpoint of the proxy.
+    """
+
+    def __init__(self, methods=(), maxsize=1000, ttl=60):
+        self.methods = set(methods)
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._results = OrderedDict()
+
+    def key(self, name, params, endpoint=None):
+        return name, canonical(params), endpoint
+
+    def get(self, key, default=None):
+        self._lock.acquire()
+        try:
+            entry = self._results.pop(key, None)
+            if entry is None or (entry[1] is not None and
+                                 entry[1] < time.time()):
+                self.misses += 1
+                return default
+            # most recently used last
+            self._results[key] = entry
+            self.hits += 1
+            return entry[0]
+        finally:
+            self._lock.release()
+
+    def set(self, key, result):
+        expires = None
+        if self.ttl is not None:
+            expires = time.time() + self.ttl
+        self._lock.acquire()
+        try:
+            self._results.pop(key, None)
+            self._results[key] = (result, expires)
+            while len(self._results) > self.maxsize:
+                self._results.popitem(last=False)
+        finally:
+            self._lock.release()
+
+    def discard(self, key):
+        self._lock.acquire()
+        try:
+            self._results.pop(key, None)
+        finally:
+            self._lock.release()
+
+    def invalidate(self, name=None, *args, **kwargs):
+        """Drop the result of a call, all results of a method or all results
+
+        Results of all endpoints are dropped.
+        """
+        if name is not None and (args or kwargs):
+            call = self.key(name, args or kwargs)[:2]
+        self._lock.acquire()
+        try:
+            if name is None:
+                self._results.clear()
+            elif args or kwargs:
+                for key in [key for key in self._results if key[:2] == call]:
+                    del self._results[key]
+            else:
+                for key in [key for key in self._results if key[0] == name]:
+                    del self._results[key]
+        finally:
+            self._lock.release()
+
+    def __len__(self):
+        return len(self._results)
+
+
+class _Notification(_Method):
+
+    def _request(self, *args, **kwargs):
+        request = super(_Notification, self)._request(*args, **kwargs)
+        # a notification has no id, or a null one before JSON-RPC 2.0
+        if self.jsonVersion in ['1.0', '1.1']:
+            request['id'] = None
+        else:
+            del request['id']
+        return request
 
 
 class JSONRPCProxy(object):
     """JSON-RPC server proxy."""
 
     def __init__(self, uri, transport=None, encoding=None,
-                 verbose=None, jsonId=None, jsonVersion=JSON_RPC_VERSION):
+                 verbose=None, jsonId=None, jsonVersion=JSON_RPC_VERSION,
+                 uniqueIds=False, cache=None):
         utype, uri = urllib.splittype(uri)
         if utype not in ("http", "https"):
             raise IOError, "Unsupported JSONRPC protocol"
@@ -119,33 +299,54 @@ class JSONRPCProxy(object):
         self.jsonId = jsonId or u'jsonrpc'
         self.jsonVersion = jsonVersion or JSON_RPC_VERSION
         self.error = None
+        # give every call its own id based on jsonId
+        self.__uniqueIds = uniqueIds
+        self.__ids = IdGenerator(self.jsonId)
+        # a ResultCache for the results of cacheable methods
+        self.__cache = cache
 
-    def __request(self, request):
-        """call a method on the remote server.
+    def _send(self, request, notify=False):
+        """Send the JSON request text and return the parsed response
 
-        This will raise a ResponseError or return the JSON result dict
+        A notification is sent without waiting for the response.
         """
         # apply encoding if any
         if self.__encoding:
             request = request.encode(self.__encoding)
         # start the call
+        if notify:
+            send = self.__transport.notify
+        else:
+            send = self.__transport.request
         try:
-            response = self.__transport.request(self.__host, self.__handler,
-                request, verbose=self.__verbose)
+            response = send(self.__host, self.__handler, request,
+                            verbose=self.__verbose)
             self.error = None
         except ResponseError, e:
             # catch error message
             self.error = unicode(str(e), 'utf-8')
             raise
+        return response
 
+    def __request(self, request, jsonId=None):
+        """call a method on the remote server.
+
+        This will raise a ResponseError or return the JSON result dict
+        """
+        return self._unwrap(self._send(request), jsonId)
+
+    def _unwrap(self, response, jsonId=None):
+        """Return the result of a response or raise its error"""
+        if jsonId is None:
+            jsonId = self.jsonId
         if isinstance(response, int):
             # that's just a status code response with no result
             logger.error('Received status code %s' % response)
         elif len(response) == 3:
             # that's a valid response format
-            if (self.jsonId is not None and
+            if (jsonId is not None and
                 response.get('id') is not None and
-                self.jsonId != response.get('id')):
+                jsonId != response.get('id')):
                 # different request id returned
                 raise ResponseError("Invalid request id returned")
             if response.get('error'):
@@ -159,11 +360,236 @@ class JSONRPCProxy(object):
 
         return response
 
+    def _getId(self):
+        # the id, or the IdGenerator, for a new call
+        if self.__uniqueIds:
+            return self.__ids
+        return self.jsonId
+
+    def _getMethod(self, call, name):
+        if self.__cache is not None:
+            return _CachedMethod(call, name, self._getId(), self.jsonVersion,
+                self.__cache, self.__host + self.__handler)
+        return _Method(call, name, self._getId(), self.jsonVersion)
+
     def __getattr__(self, name):
         """This let us call methods on remote server."""
-        return _Method(self.__request, name, self.jsonId, self.jsonVersion)
+        return self._getMethod(self.__request, name)
 
     def __repr__(self):
         return ("<JSONProxy for %s%s>" % (self.__host, self.__handler))
 
     __str__ = __repr__
+
+
+class AsyncJSONRPCProxy(JSONRPCProxy):
+    """JSON-RPC server proxy for non-blocking calls.
+
+    Calls return a transport.Future instead of the result. They run on the
+    event loop of the AsyncTransport, either in its run() method or while
+    waiting for a result:
+
+      transport = AsyncTransport()
+      proxy = AsyncJSONRPCProxy('http://localhost/', transport=transport)
+      calls = [proxy.getUser(name) for name in names]
+      transport.run()
+      users = [call.result() for call in calls]
+    """
+
+    def __init__(self, uri, transport=None, encoding=None,
+                 verbose=None, jsonId=None, jsonVersion=JSON_RPC_VERSION,
+                 uniqueIds=False, cache=None):
+        # AsyncTransport doesn't speak SSL
+        if urllib.splittype(uri)[0] != "http":
+            raise IOError, "Unsupported asynchronous JSONRPC protocol"
+        if transport is None:
+            transport = AsyncTransport()
+        super(AsyncJSONRPCProxy, self).__init__(uri, transport, encoding,
+            verbose, jsonId, jsonVersion, uniqueIds, cache)
+
+    def __request(self, request, jsonId=None):
+        """call a method on the remote server, return a Future"""
+        response = self._send(request)
+        # waiting for the result runs the loop until the response is there
+        future = Future(lambda future: response.exception())
+
+        def unwrap(response):
+            try:
+                future.setResult(self._unwrap(response.result(), jsonId))
+            except Exception, e:
+                future.setException(e)
+
+        response.addCallback(unwrap)
+        return future
+
+    def __getattr__(self, name):
+        """This let us call methods on remote server."""
+        return self._getMethod(self.__request, name)
+
+
+def mapCalls(proxy, name, params, maxWorkers=10):
+    """Call the remote method name once for every item of params.
+
+    An item is a dict of named parameters, a tuple or list of positional
+    parameters or a single parameter. The calls run in parallel on up to
+    maxWorkers threads sharing the connection pool of the proxy transport.
+    Returns a done transport.Future per item in the order of params, its
+    result() returns the result or raises the error of that call.
+    """
+    method = getattr(proxy, name)
+    params = list(params)
+    futures = [Future() for item in params]
+    items = iter(enumerate(params))
+    lock = threading.Lock()
+
+    def work():
+        while 1:
+            lock.acquire()
+            try:
+                try:
+                    index, item = items.next()
+                except StopIteration:
+                    return
+            finally:
+                lock.release()
+            if isinstance(item, dict):
+                args, kwargs = (), item
+            elif isinstance(item, (tuple, list)):
+                args, kwargs = item, {}
+            else:
+                args, kwargs = (item,), {}
+            try:
+                futures[index].setResult(method(*args, **kwargs))
+            except Exception, e:
+                futures[index].setException(e)
+
+    workers = [threading.Thread(target=work)
+               for i in range(min(maxWorkers, len(params)))]
+    for worker in workers:
+        worker.setDaemon(True)
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return futures
+
+
+class BatchResult(object):
+    """The result of a call in a batch.
+
+    It is a placeholder until the batch is sent.
+    """
+
+    def __init__(self, request):
+        self.request = request
+        self.response = None
+
+    def done(self):
+        """Whether the response for the call is there"""
+        return self.response is not None
+
+    @property
+    def error(self):
+        if self.response is None:
+            return None
+        return self.response.get('error')
+
+    def result(self):
+        """Return the result or raise a ResponseError for an error"""
+        if self.response is None:
+            raise ValueError('The batch was not sent yet')
+        if self.error:
+            raise ResponseError("Received error from server: %s" %
+                                self.error)
+        return self.response.get('result')
+
+
+class JSONRPCBatch(object):
+    """Collect calls on a proxy and send them as one JSON-RPC 2.0 batch.
+
+    Calls return a BatchResult. Calling the batch, or leaving it as a
+    context manager, sends the collected calls in one request:
+
+      with JSONRPCBatch(proxy) as batch:
+          user = batch.getUser(u'jessy')
+          count = batch.count()
+      user.result()
+
+    Responses are matched to the calls by generated ids, every call gets
+    its own result or error.
+    """
+
+    def __init__(self, proxy):
+        if proxy.jsonVersion != '2.0':
+            raise ValueError('Batch calls need JSON-RPC 2.0')
+        self.__proxy = proxy
+        self.__results = []
+        self.__ids = IdGenerator(proxy.jsonId)
+
+    def __add(self, request):
+        result = BatchResult(request)
+        self.__results.append(result)
+        return result
+
+    def __getattr__(self, name):
+        return _BatchMethod(self.__add, name, self.__ids,
+            self.__proxy.jsonVersion)
+
+    def __call__(self):
+        """Send the collected calls and return their BatchResults"""
+        results = self.__results
+        self.__results = []
+        if not results:
+            # an empty batch is an invalid request
+            return results
+        json = zope.component.getUtility(interfaces.IJSONWriter)
+        data = json.write([result.request for result in results])
+        try:
+            response = self.__proxy._send(data)
+        except socket.error, msg:
+            raise ResponseError("JSONRPC server connection error.")
+
+        if isinstance(response, dict) and response.get('error'):
+            # the server rejected the batch as a whole
+            self.__proxy.error = response['error']
+            raise ResponseError("Received error from server: %s" %
+                                self.__proxy.error)
+        if not isinstance(response, list):
+            raise ResponseError("Invalid batch response")
+        responses = {}
+        for item in response:
+            if isinstance(item, dict):
+                responses[item.get('id')] = item
+        for result in results:
+            result.response = responses.get(result.request['id'],
+                {'error': u'No response for %s' % result.request['id']})
+        return results
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        # don't send the calls if the block failed
+        if type is None:
+            self()
+
+
+class JSONRPCNotifier(object):
+    """Send notifications, calls without a response, through a proxy:
+
+      notifier = JSONRPCNotifier(proxy)
+      notifier.log(u'started')
+
+    A call returns once the request is sent, the transport reads the HTTP
+    response before it uses the connection again. With an AsyncTransport
+    a call returns a Future that is done once the response was read.
+    """
+
+    def __init__(self, proxy):
+        self.__proxy = proxy
+
+    def __send(self, request, jsonId=None):
+        return self.__proxy._send(request, notify=True)
+
+    def __getattr__(self, name):
+        return _Notification(self.__send, name, None,
+            self.__proxy.jsonVersion)
@@ -19,14 +19,31 @@ __docformat__ = "reStructuredText"
 import string
 import urllib
 import httplib
+import asynchat
+import asyncore
 import base64
+import collections
+import logging
+import select
+import socket
+import sys
+import threading
+import time
 import types
+import zlib
+from cStringIO import StringIO
 
 import zope.component
+from z3c.json import instrumentation
 from z3c.json import interfaces
 from z3c.json.exceptions import ProtocolError
 from z3c.json.exceptions import ResponseError
 
+logger = logging.getLogger(__name__)
+
+# guards setting up the state of transports on first use
+_setUpLock = threading.Lock()
+
 
 def getparser():
     un = Unmarshaller()
@@ -36,33 +53,168 @@ def getparser():
 
 class Unmarshaller(object):
     def __init__(self):
-        self.data = None
+        self._chunks = []
+        json = zope.component.getUtility(interfaces.IJSONReader)
+        # parse while the response comes in if the reader supports it, its
+        # backend may rather read the whole response
+        factory = getattr(json, 'parser', None)
+        if factory is not None:
+            self._parser = factory()
+        else:
+            self._parser = None
+        self.incremental = self._parser is not None
 
     def feed(self, data):
-        if self.data is None:
-            self.data = data
+        if self._parser is not None:
+            # reader raises ResponseError on read error
+            self._parser.feed(data)
         else:
-            self.data = self.data + data
+            self._chunks.append(data)
 
     def close(self):
+        if self._parser is not None:
+            return self._parser.close()
+        # join is linear and returns a single chunk as is
+        data = ''.join(self._chunks)
+        self._chunks = []
         # convert to json, reader raises ResponseError on read error
         json = zope.component.getUtility(interfaces.IJSONReader)
-        return json.read(self.data)
+        return json.read(data)
 
 
 class Parser(object):
     def __init__(self, unmarshaller):
         self._target = unmarshaller
-        self.data = None
 
     def feed(self, data):
-        if self.data is None:
-            self.data = data
-        else:
-            self.data = self.data + data
+        self._target.feed(data)
+
+    def close(self):
+        pass
+
+
+class DecodingParser(object):
+    """Decompresses a gzip or deflate encoded body while it is fed"""
+
+    def __init__(self, target, encoding):
+        if encoding not in ('gzip', 'x-gzip', 'deflate'):
+            raise ResponseError("Unsupported content encoding %r" % encoding)
+        self._target = target
+        self._encoding = encoding
+        self._decompressor = None
+        self._head = ''
+
+    def feed(self, data):
+        if self._decompressor is None:
+            # deflate is meant to be zlib data, some servers send it raw
+            data = self._head + data
+            if len(data) < 2:
+                self._head = data
+                return
+            self._head = ''
+            if self._encoding != 'deflate':
+                wbits = 16 + zlib.MAX_WBITS
+            elif ord(data[0]) & 0x0f == 8 and (
+                ord(data[0]) * 256 + ord(data[1])) % 31 == 0:
+                wbits = zlib.MAX_WBITS
+            else:
+                wbits = -zlib.MAX_WBITS
+            self._decompressor = zlib.decompressobj(wbits)
+        try:
+            data = self._decompressor.decompress(data)
+        except zlib.error, e:
+            raise ResponseError("Invalid %s encoded response: %s" % (
+                self._encoding, e))
+        if data:
+            self._target.feed(data)
 
     def close(self):
-        self._target.feed(self.data)
+        if self._decompressor is None:
+            raise ResponseError("Invalid %s encoded response" % self._encoding)
+        self._target.feed(self._decompressor.flush())
+        self._target.close()
+
+
+def decodingParser(parser, encoding):
+    """Return a parser decoding the given Content-Encoding for parser"""
+    encoding = (encoding or '').strip().lower()
+    if encoding in ('', 'identity'):
+        return parser
+    return DecodingParser(parser, encoding)
+
+
+def requestURL(host, handler):
+    """Return the URL of a request without the user and password of host"""
+    return urllib.splituser(host)[1] + handler
+
+
+class ConnectionPool(object):
+    """Idle keep-alive connections by host.
+
+    At most maxsize idle connections are kept per host, connections idle
+    for more than idletimeout seconds or closed by the server are dropped.
+    The pool may be shared by threads, a connection is only handed out once.
+    """
+
+    def __init__(self, maxsize=10, idletimeout=60):
+        self.maxsize = maxsize
+        self.idletimeout = idletimeout
+        self._lock = threading.Lock()
+        self._idle = {}
+
+    def get(self, host):
+        """Return an idle connection to host or None"""
+        while 1:
+            self._lock.acquire()
+            try:
+                connections = self._idle.get(host)
+                if not connections:
+                    return None
+                connection, released = connections.pop()
+            finally:
+                self._lock.release()
+            if (time.time() - released < self.idletimeout and
+                not self.isStale(connection)):
+                return connection
+            connection.close()
+
+    def put(self, host, connection):
+        """Keep connection for later use"""
+        self._lock.acquire()
+        try:
+            connections = self._idle.setdefault(host, [])
+            if len(connections) < self.maxsize:
+                connections.append((connection, time.time()))
+                return
+        finally:
+            self._lock.release()
+        connection.close()
+
+    def isStale(self, connection):
+        """An idle connection is stale if the server closed it
+
+        A readable idle socket means end of file (or garbage) here.
+        """
+        sock = connection.sock
+        if sock is None:
+            return True
+        try:
+            readable, writable, errors = select.select([sock], [], [], 0)
+        except (select.error, socket.error, ValueError):
+            return True
+        return bool(readable)
+
+    def clear(self):
+        """Close all idle connections"""
+        self._lock.acquire()
+        try:
+            idle = self._idle
+            self._idle = {}
+        finally:
+            self._lock.release()
+        for connections in idle.values():
+            for connection, released in connections:
+                connection.close()
 
 
 class Transport(object):
@@ -84,33 +236,183 @@ class Transport(object):
 
     user_agent = "z3c.jsonrpc/0.5.0"
 
-    def request(self, host, handler, request_body, verbose=0):
-        # issue JSON-RPC request
+    # the keep-alive connections, a new ConnectionPool if not given
+    pool = None
+
+    # bytes read at a time if the body size is unknown or it gets parsed
+    # while reading
+    bufsize = 65536
 
-        h = self.make_connection(host)
-        if verbose:
-            h.set_debuglevel(1)
+    # ask for gzip or deflate compressed responses
+    accept_gzip_encoding = True
 
-        self.send_request(h, handler, request_body)
-        self.send_host(h, host)
-        self.send_user_agent(h)
-        self.send_content(h, request_body)
+    # gzip request bodies larger than this many bytes, None never does
+    encode_threshold = None
 
-        errcode, errmsg, headers = h.getreply()
+    # connections with the response of a notification still to read and
+    # the lock guarding them, set up with the pool on first use for
+    # subclasses which don't call __init__
+    _pending = None
+    _lock = None
+
+    def __init__(self, pool=None):
+        if pool is None:
+            pool = ConnectionPool()
+        self.pool = pool
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def _setUp(self):
+        _setUpLock.acquire()
+        try:
+            if self._lock is None:
+                self._pending = {}
+                self._lock = threading.Lock()
+            if self.pool is None:
+                self.pool = ConnectionPool()
+        finally:
+            _setUpLock.release()
 
-        if errcode != 200:
-            raise ProtocolError(host + handler, errcode, errmsg, headers)
+    def request(self, host, handler, request_body, verbose=0):
+        if not instrumentation.subscribers:
+            return self._request(host, handler, request_body, verbose)[0]
+        # timed until the response is read, an incremental parser decodes
+        # it while it is read, other readers after that
+        start = instrumentation.clock()
+        response = None
+        try:
+            result, response = self._request(host, handler, request_body,
+                                             verbose)
+            return result
+        finally:
+            if response is None:
+                # failed requests are reported as well
+                end = instrumentation.clock()
+                length = None
+            else:
+                end = getattr(response, 'readEnd', None)
+                if end is None:
+                    end = instrumentation.clock()
+                length = response.getheader('content-length')
+            instrumentation.notify(instrumentation.TimingEvent(
+                instrumentation.REQUEST, end - start, len(request_body),
+                responseSize=length and int(length),
+                url=requestURL(host, handler), error=response is None))
+
+    def _request(self, host, handler, request_body, verbose):
+        # issue JSON-RPC request, return the result and the response
+        h, response = self._send(host, handler, request_body, verbose, True)
+
+        if response.status != 200:
+            h.close()
+            raise ProtocolError(host + handler, response.status,
+                                response.reason, response.msg)
 
         self.verbose = verbose
 
-        self.parse_response_headers(headers)
+        self.parse_response_headers(response.msg)
 
         try:
-            sock = h._conn.sock
-        except AttributeError:
-            sock = None
+            result = self._parse_response(response, None)
+        except:
+            h.close()
+            raise
+        if response.will_close:
+            h.close()
+        else:
+            self.pool.put(host, h)
+        return result, response
 
-        return self._parse_response(h.getfile(), sock)
+    def notify(self, host, handler, request_body, verbose=0):
+        """Send a JSON-RPC notification, don't wait for the response
+
+        The response is read before the connection is used again.
+        """
+        h, response = self._send(host, handler, request_body, verbose, False)
+        if self._lock is None:
+            self._setUp()
+        self._lock.acquire()
+        try:
+            self._pending.setdefault(host, []).append(h)
+        finally:
+            self._lock.release()
+
+    def _send(self, host, handler, request_body, verbose, wait):
+        # send the request, return the connection and the response if wait
+        if self._lock is None or self.pool is None:
+            self._setUp()
+
+        # a reused connection may have been closed by the server while it
+        # was idle, retry once with a new one then
+        h = self.get_connection(host)
+        reused = h is not None
+        while 1:
+            if h is None:
+                h = self.make_connection(host)
+            if verbose:
+                h.set_debuglevel(1)
+            try:
+                self.send_request(h, handler, request_body)
+                self.send_host(h, host)
+                self.send_user_agent(h)
+                self.send_content(h, request_body)
+                if not wait:
+                    return h, None
+                response = h.getresponse()
+            except (socket.error, httplib.HTTPException):
+                h.close()
+                if not reused:
+                    raise
+                h = None
+                reused = False
+                continue
+            return h, response
+
+    def get_connection(self, host):
+        """Return an idle connection to host or None"""
+        if self._lock is None or self.pool is None:
+            self._setUp()
+        while 1:
+            self._lock.acquire()
+            try:
+                pending = self._pending.get(host)
+                h = pending and pending.pop() or None
+            finally:
+                self._lock.release()
+            if h is None:
+                return self.pool.get(host)
+            if self.drain(h):
+                return h
+            h.close()
+
+    def drain(self, connection):
+        """Read the response of a notification, True if connection is reusable
+        """
+        try:
+            response = connection.getresponse()
+            response.read()
+        except (socket.error, httplib.HTTPException):
+            return False
+        if response.status // 100 != 2:
+            logger.warning('Notification failed with %s %s' % (
+                response.status, response.reason))
+        return not response.will_close
+
+    def close(self):
+        """Close the idle keep-alive connections"""
+        if self._lock is None:
+            self._setUp()
+        self._lock.acquire()
+        try:
+            pending = self._pending
+            self._pending = {}
+        finally:
+            self._lock.release()
+        for connections in pending.values():
+            for connection in connections:
+                connection.close()
+        if self.pool is not None:
+            self.pool.clear()
 
     def getparser(self):
         """Get parser and unmarshaller."""
@@ -148,10 +450,14 @@ class Transport(object):
     def make_connection(self, host):
         # create a HTTP connection object from a host descriptor
         host, extra_headers, x509 = self.get_host_info(host)
-        return httplib.HTTP(host)
+        return httplib.HTTPConnection(host)
 
     def send_request(self, connection, handler, request_body):
-        connection.putrequest("POST", handler)
+        # send_host sends the Host header
+        connection.putrequest("POST", handler, skip_host=True,
+                              skip_accept_encoding=self.accept_gzip_encoding)
+        if self.accept_gzip_encoding:
+            connection.putheader("Accept-Encoding", "gzip, deflate")
 
     def send_host(self, connection, host):
         host, extra_headers, x509 = self.get_host_info(host)
@@ -166,11 +472,21 @@ class Transport(object):
         connection.putheader("User-Agent", self.user_agent)
 
     def send_content(self, connection, request_body):
+        if isinstance(request_body, unicode):
+            # httplib would encode it when sending anyway
+            request_body = request_body.encode('ascii')
+        if (self.encode_threshold is not None and
+            len(request_body) > self.encode_threshold):
+            compressor = zlib.compressobj(6, zlib.DEFLATED,
+                                          16 + zlib.MAX_WBITS)
+            request_body = (compressor.compress(request_body) +
+                            compressor.flush())
+            connection.putheader("Content-Encoding", "gzip")
         connection.putheader("Content-Type", "application/json")
         connection.putheader("Content-Length", str(len(request_body)))
-        connection.endheaders()
-        if request_body:
-            connection.send(request_body)
+        # send headers and body in one packet, a separate send waits for
+        # the delayed ACK of the server on a kept alive connection
+        connection.endheaders(request_body or None)
 
     def parse_response_headers(self, headers):
         pass
@@ -183,12 +499,22 @@ class Transport(object):
         # read response from input file/socket, and parse it
 
         p, u = self.getparser()
+        getheader = getattr(file, 'getheader', None)
+        if getheader is not None:
+            p = decodingParser(p, getheader('content-encoding'))
+
+        # a reader without incremental parsing needs the whole body anyway,
+        # read it in one go if the Content-Length is known
+        size = self.bufsize
+        length = getattr(file, 'length', None)
+        if not sock and length and not getattr(u, 'incremental', False):
+            size = length
 
         while 1:
             if sock:
-                response = sock.recv(1024)
+                response = sock.recv(size)
             else:
-                response = file.read(1024)
+                response = file.read(size)
             if not response:
                 break
             if self.verbose:
@@ -196,6 +522,9 @@ class Transport(object):
             p.feed(response)
 
         file.close()
+        if instrumentation.subscribers:
+            # the end of the request for its timing, before the decoding
+            file.readEnd = instrumentation.clock()
         p.close()
 
         return u.close()
@@ -212,13 +541,13 @@ class SafeTransportMixin(object):
         """
         host, extra_headers, x509 = self.get_host_info(host)
         try:
-            HTTPS = httplib.HTTPS
+            HTTPSConnection = httplib.HTTPSConnection
         except AttributeError:
             raise NotImplementedError(
                 "your version of httplib doesn't support HTTPS"
                 )
         else:
-            return HTTPS(host, None, **(x509 or {}))
+            return HTTPSConnection(host, None, **(x509 or {}))
 
 class SafeTransport(SafeTransportMixin, Transport):
     """Handles an HTTPS transaction to an JSON-RPC server."""
@@ -226,7 +555,8 @@ class SafeTransport(SafeTransportMixin, Transport):
 class BasicAuthTransport(Transport):
     """Handles a transaction to an JSON-RPC server using HTTP basic auth."""
 
-    def __init__(self, username=None, password=None, verbose=0):
+    def __init__(self, username=None, password=None, verbose=0, pool=None):
+        super(BasicAuthTransport, self).__init__(pool)
         self.username=username
         self.password=password
         self.verbose=verbose
@@ -241,4 +571,434 @@ class BasicAuthTransport(Transport):
         super(BasicAuthTransport, self).send_content(connection, request_body)
 
 class SafeBasicAuthTransport(SafeTransportMixin, BasicAuthTransport):
-    """Basic AUTH through HTTPS"""
\ No newline at end of file
+    """Basic AUTH through HTTPS"""
+
+
+class Future(object):
+    """The outcome of an asynchronous call.
+
+    wait is called with the future to run the event loop until the future
+    is done, result() and exception() do so for a pending future.
+    """
+
+    def __init__(self, wait=None):
+        self._wait = wait
+        self._done = False
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+
+    def done(self):
+        return self._done
+
+    def result(self):
+        """Return the result or raise the exception of a failed call"""
+        exception = self.exception()
+        if exception is not None:
+            raise exception
+        return self._result
+
+    def exception(self):
+        """Return the exception of a failed call or None"""
+        if not self._done and self._wait is not None:
+            self._wait(self)
+        if not self._done:
+            raise ValueError('The call is not done yet')
+        return self._exception
+
+    def addCallback(self, callback):
+        """Call callback with the future once it is done"""
+        if self._done:
+            self._call(callback)
+        else:
+            self._callbacks.append(callback)
+
+    def setResult(self, result):
+        self._result = result
+        self._finish()
+
+    def setException(self, exception):
+        self._exception = exception
+        self._finish()
+
+    def _finish(self):
+        self._done = True
+        callbacks = self._callbacks
+        self._callbacks = []
+        for callback in callbacks:
+            self._call(callback)
+
+    def _call(self, callback):
+        # an error in one callback must not break the event loop
+        try:
+            callback(self)
+        except Exception:
+            logger.exception('Error in callback of %r' % self)
+
+
+class RequestBuffer(object):
+    """Collects a request written with the httplib connection methods
+
+    This lets AsyncTransport reuse the send_* methods of Transport.
+    """
+
+    def __init__(self):
+        self.data = []
+
+    def putrequest(self, method, url, skip_host=0, skip_accept_encoding=0):
+        self.data.append('%s %s HTTP/1.1\r\n' % (method, url))
+
+    def putheader(self, header, *values):
+        self.data.append('%s: %s\r\n' % (header, '\r\n\t'.join(values)))
+
+    def endheaders(self, message_body=None):
+        self.data.append('\r\n')
+        if message_body:
+            self.data.append(message_body)
+
+    def send(self, data):
+        self.data.append(data)
+
+    def getvalue(self):
+        data = ''.join(self.data)
+        if isinstance(data, unicode):
+            # like httplib, the caller encodes non ascii request bodies
+            data = data.encode('ascii')
+        return data
+
+
+class AsyncRequest(object):
+    """A request waiting for or running on an HTTPChannel"""
+
+    def __init__(self, host, handler, data, future, notification=False):
+        self.host = host
+        self.handler = handler
+        self.data = data
+        self.future = future
+        self.notification = notification
+        self.retried = False
+        # when the response was read, for the timing of the request
+        self.readEnd = None
+
+
+class NullUnmarshaller(object):
+    """Ignores the response body of a notification"""
+
+    def feed(self, data):
+        pass
+
+    def close(self):
+        return None
+
+
+class HTTPChannel(asynchat.async_chat):
+    """A non-blocking keep-alive HTTP/1.1 connection of an AsyncTransport
+
+    It runs one request at a time and parses the response body while it
+    comes in. Content-Length, chunked and connection close delimited
+    bodies are supported.
+    """
+
+    def __init__(self, transport, host, address):
+        asynchat.async_chat.__init__(self, map=transport.map)
+        self.transport = transport
+        self.host = host
+        self.request = None
+        self.reused = False
+        self.state = 'idle'
+        self.buffer = []
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            self.connect(address)
+        except socket.error:
+            self.close()
+            raise
+
+    def start(self, request):
+        """Send the request"""
+        self.request = request
+        self.received = False
+        self.keepalive = False
+        self.state = 'headers'
+        self.buffer = []
+        if request.notification:
+            self.parser = self.unmarshaller = NullUnmarshaller()
+        else:
+            self.parser, self.unmarshaller = self.transport.getparser()
+        self.set_terminator('\r\n\r\n')
+        self.push(request.data)
+
+    def collect_incoming_data(self, data):
+        self.received = True
+        if self.state in ('body', 'chunk'):
+            self.parser.feed(data)
+        elif self.request is not None:
+            self.buffer.append(data)
+
+    def found_terminator(self):
+        data = ''.join(self.buffer)
+        self.buffer = []
+        if self.state == 'headers':
+            self.startResponse(data)
+        elif self.state == 'body':
+            self.finish()
+        elif self.state == 'chunksize':
+            try:
+                size = int(data.split(';', 1)[0], 16)
+            except ValueError:
+                raise ResponseError("Invalid chunked response")
+            if size:
+                self.state = 'chunk'
+                self.set_terminator(size)
+            else:
+                self.state = 'trailer'
+        elif self.state == 'chunk':
+            # the CRLF after the chunk data
+            self.state = 'chunkend'
+            self.set_terminator('\r\n')
+        elif self.state == 'chunkend':
+            self.state = 'chunksize'
+        elif self.state == 'trailer':
+            if not data:
+                self.finish()
+
+    def startResponse(self, data):
+        status, headers = data.split('\r\n', 1)
+        try:
+            version, status, reason = (status.split(None, 2) + [''])[:3]
+            status = int(status)
+        except ValueError:
+            raise ResponseError("Invalid HTTP response")
+        if status == 100:
+            # the real response follows
+            return
+        headers = httplib.HTTPMessage(StringIO(headers + '\r\n\r\n'))
+        if status != 200 and not (self.request.notification and
+                                  status // 100 == 2):
+            raise ProtocolError(self.host + self.request.handler, status,
+                                reason, headers)
+
+        connection = headers.getheader('connection', '').lower()
+        if version == 'HTTP/1.0':
+            self.keepalive = connection == 'keep-alive'
+        else:
+            self.keepalive = connection != 'close'
+        self.transport.parse_response_headers(headers)
+        self.parser = decodingParser(self.parser,
+                                     headers.getheader('content-encoding'))
+
+        length = headers.getheader('content-length')
+        if status == 204:
+            # no body at all
+            self.finish()
+        elif headers.getheader('transfer-encoding', '').lower() == 'chunked':
+            self.state = 'chunksize'
+            self.set_terminator('\r\n')
+        elif length is not None:
+            try:
+                length = int(length)
+            except ValueError:
+                raise ResponseError("Invalid HTTP response")
+            if not length:
+                self.finish()
+                return
+            self.state = 'body'
+            self.set_terminator(length)
+        else:
+            # the body ends with the connection
+            self.state = 'body'
+            self.keepalive = False
+            self.set_terminator(None)
+
+    def finish(self):
+        request = self.request
+        self.request = None
+        self.state = 'idle'
+        if instrumentation.subscribers:
+            request.readEnd = instrumentation.clock()
+        try:
+            self.parser.close()
+            result = self.unmarshaller.close()
+        except Exception, e:
+            self.close()
+            request.future.setException(e)
+            return
+        # free the channel for the next request before the callbacks run
+        if self.keepalive:
+            self.transport.release(self)
+        else:
+            self.close()
+        request.future.setResult(result)
+
+    def handle_close(self):
+        if (self.request is not None and self.state == 'body' and
+            self.get_terminator() is None):
+            self.finish()
+            return
+        request = self.request
+        self.request = None
+        self.close()
+        if request is None:
+            return
+        if self.reused and not self.received and not request.retried:
+            # the server closed the idle connection, retry once
+            request.retried = True
+            self.transport.dispatch(request)
+        else:
+            request.future.setException(
+                ResponseError("JSONRPC server connection error."))
+
+    def handle_error(self):
+        error = sys.exc_info()[1]
+        if not isinstance(error, (ResponseError, ProtocolError)):
+            logger.debug('Error on %s' % self.host, exc_info=True)
+            error = ResponseError("JSONRPC server connection error.")
+        request = self.request
+        self.request = None
+        self.close()
+        if request is not None:
+            request.future.setException(error)
+
+    def close(self):
+        asynchat.async_chat.close(self)
+        self.transport.discard(self)
+
+
+class AsyncTransport(Transport):
+    """Non-blocking transport running many requests on one event loop.
+
+    request() returns a Future for the response. The requests make
+    progress while the asyncore loop runs, in run() or while a result is
+    waited for. Up to maxconnections keep-alive connections are opened per
+    host and reused, more requests wait for a free connection. An instance
+    must only be used by one thread.
+    """
+
+    # seconds to wait in one poll of the loop
+    polltimeout = 1.0
+
+    def __init__(self, maxconnections=10, map=None):
+        super(AsyncTransport, self).__init__()
+        if map is None:
+            map = {}
+        self.map = map
+        self.maxconnections = maxconnections
+        self._channels = {}
+        self._idle = {}
+        self._queued = {}
+        self._outstanding = 0
+
+    def request(self, host, handler, request_body, verbose=0,
+                notification=False):
+        # issue JSON-RPC request, return a Future for the response
+        buffer = RequestBuffer()
+        self.send_request(buffer, handler, request_body)
+        self.send_host(buffer, host)
+        self.send_user_agent(buffer)
+        self.send_content(buffer, request_body)
+
+        future = Future(self.wait)
+        self._outstanding += 1
+        future.addCallback(self._finished)
+        request = AsyncRequest(host, handler, buffer.getvalue(), future,
+                               notification)
+        if instrumentation.subscribers and not notification:
+            future.addCallback(self._timer(request, len(request_body)))
+        self.dispatch(request)
+        return future
+
+    def notify(self, host, handler, request_body, verbose=0):
+        """Send a JSON-RPC notification
+
+        Returns a Future for None, done once the response was read.
+        """
+        return self.request(host, handler, request_body, verbose, True)
+
+    def _finished(self, future):
+        self._outstanding -= 1
+
+    def _timer(self, request, size):
+        # return a callback reporting the request until its response was
+        # read or it failed, the time it was queued for a connection is
+        # included
+        start = instrumentation.clock()
+        url = requestURL(request.host, request.handler)
+        def report(future):
+            error = future.exception() is not None
+            end = request.readEnd
+            if error or end is None:
+                end = instrumentation.clock()
+            instrumentation.notify(instrumentation.TimingEvent(
+                instrumentation.REQUEST, end - start, size, url=url,
+                error=error))
+        return report
+
+    def dispatch(self, request):
+        """Start the request on a free connection or queue it"""
+        host = request.host
+        idle = self._idle.get(host)
+        if idle:
+            channel = idle.pop()
+            channel.reused = True
+            channel.start(request)
+            return
+        channels = self._channels.setdefault(host, [])
+        if len(channels) >= self.maxconnections:
+            self._queued.setdefault(host, collections.deque()).append(request)
+            return
+        address, extra_headers, x509 = self.get_host_info(host)
+        address, port = urllib.splitport(address)
+        try:
+            channel = HTTPChannel(self, host,
+                                  (address, int(port or httplib.HTTP_PORT)))
+        except (socket.error, ValueError):
+            request.future.setException(
+                ResponseError("JSONRPC server connection error."))
+            return
+        channels.append(channel)
+        channel.start(request)
+
+    def release(self, channel):
+        """Reuse a channel after a complete response"""
+        queued = self._queued.get(channel.host)
+        if queued:
+            channel.reused = True
+            channel.start(queued.popleft())
+        else:
+            self._idle.setdefault(channel.host, []).append(channel)
+
+    def discard(self, channel):
+        """Forget a closed channel"""
+        for channels in (self._channels, self._idle):
+            if channel in channels.get(channel.host, ()):
+                channels[channel.host].remove(channel)
+        queued = self._queued.get(channel.host)
+        if queued:
+            self.dispatch(queued.popleft())
+
+    def wait(self, future):
+        """Run the loop until future is done"""
+        while not future.done() and self.map:
+            asyncore.loop(self.polltimeout, True, self.map, 1)
+
+    def run(self, timeout=None):
+        """Run the loop until all requests are done
+
+        Returns False if they are not done within timeout seconds.
+        """
+        if timeout is not None:
+            deadline = time.time() + timeout
+        while self._outstanding and self.map:
+            polltimeout = self.polltimeout
+            if timeout is not None:
+                polltimeout = min(polltimeout, deadline - time.time())
+                if polltimeout <= 0:
+                    break
+            asyncore.loop(polltimeout, True, self.map, 1)
+        return not self._outstanding
+
+    def close(self):
+        """Close the idle keep-alive connections"""
+        for channels in self._idle.values():
+            for channel in list(channels):
+                channel.close()